@@ -17,6 +17,7 @@ import scipy.stats
 import math
 import scipy.spatial
 import itertools
+import collections
 
 from podi_definitions import *
 from podi_commandline import *
@@ -29,9 +30,62 @@ from podi_photcalib import estimate_zeropoint, estimate_mean_star_color
 
 import queue
 import multiprocessing
+import multiprocessing.shared_memory
+
+# numba is optional - when available, the offset-voting inner loop of
+# count_matches runs as a compiled kernel instead of the numpy fallback
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# numexpr is optional - when available, elementwise residual arithmetic
+# is fused into single-pass kernels instead of one numpy pass per operator
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 max_pointing_error = 8.
 
+#
+# kD-tree construction parameters tuned for catalog-matching workloads:
+# the sliding-midpoint rule (no node compaction or balancing) is much
+# cheaper to build and queries sky-catalog data faster than the scipy
+# defaults, and slightly larger leaves favor the linear leaf scan on the
+# fairly small trees we build here.
+#
+kdtree_opts = {
+    'leafsize': 32,
+    'compact_nodes': False,
+    'balanced_tree': False,
+}
+
+#
+# Small container for a catalog that already lives in cos(declination)-
+# scaled space, bundled with the scale factor that was applied. Functions
+# that accept one of these can skip their own copy+scale step, so a
+# catalog that is matched several times (e.g. the reference catalog) only
+# pays for the scaling once; coordinates are converted back to true
+# Ra/Dec at each function's output boundary as before.
+#
+ScaledCatalog = collections.namedtuple('ScaledCatalog', ['data', 'cos_dec'])
+
+def scale_catalog(catalog, cos_dec=None):
+    """
+
+    Apply the cos(declination) correction to a catalog and return it
+    wrapped in a `ScaledCatalog` for re-use across several matching calls.
+
+    """
+    if (cos_dec is None):
+        max_declination = numpy.max(numpy.fabs(catalog[:,1]))
+        if (max_declination > 85): max_declination = 85
+        cos_dec = math.cos(math.radians(max_declination))
+    scaled = catalog.copy()
+    scaled[:,0] *= cos_dec
+    return ScaledCatalog(scaled, cos_dec)
+
 import podi_logging
 import logging
 
@@ -46,24 +100,58 @@ def select_brightest(radec, mags, n):
 
     """
 
-    # print mags
-    si = numpy.argsort(mags[:,0])
-    # print si
-
-    output_radec = numpy.zeros(shape=(n, radec.shape[1]))
-    output_mags = numpy.zeros(shape=(n, mags.shape[1]))
-
-    for i in range(n):
-        # print si[i], mags[si[i],0]
-        output_radec[i,:] = radec[si[i],:]
-        output_mags[i,:] = mags[si[i],:]
-
-    return output_radec, output_mags
-
-
-def count_matches(src_cat, ref_cat, 
-                  pointing_error=(max_pointing_error/60.), 
-                  matching_radius=(4./3600.), debugangle=None):
+    # If the catalog is no larger than requested just return it sorted
+    if (n >= mags.shape[0]):
+        si = numpy.argsort(mags[:,0])
+        return radec[si], mags[si]
+
+    # Pick the n brightest entries with an O(N) argpartition instead of a
+    # full sort, then order just those few by brightness
+    si = numpy.argpartition(mags[:,0], n)[:n]
+    si = si[numpy.argsort(mags[si,0])]
+
+    return radec[si], mags[si]
+
+
+if (numba is not None):
+    @numba.njit(cache=True)
+    def _accumulate_offset_votes(ref_cat, src_chunk, ref_idx, match_counts,
+                                 count_grid, grid_range):
+        """
+
+        Compiled inner loop for `count_matches`: compute all source-to-
+        reference offsets for one chunk and vote them directly into the
+        persistent count grid, without ever materializing the offset array
+        or re-deriving histogram edges. Binning matches numpy.histogram2d
+        with `count_grid.shape` bins over [-grid_range, grid_range] (in
+        arcsec) on both axes.
+
+        """
+        grid_size = count_grid.shape[0]
+        norm = grid_size / (2. * grid_range)
+        p = 0
+        for i in range(match_counts.shape[0]):
+            for _ in range(match_counts[i]):
+                dx = (ref_cat[ref_idx[p], 0] - src_chunk[i, 0]) * 3600.
+                dy = (ref_cat[ref_idx[p], 1] - src_chunk[i, 1]) * 3600.
+                p += 1
+                fx = (dx + grid_range) * norm
+                fy = (dy + grid_range) * norm
+                if (fx < 0. or fx > grid_size or fy < 0. or fy > grid_size):
+                    continue
+                ix = int(fx)
+                iy = int(fy)
+                # the right-most bin edge is inclusive, as in histogram2d
+                if (ix == grid_size): ix -= 1
+                if (iy == grid_size): iy -= 1
+                count_grid[ix, iy] += 1.
+
+
+def count_matches(src_cat, ref_cat,
+                  pointing_error=(max_pointing_error/60.),
+                  matching_radius=(4./3600.), debugangle=None,
+                  ref_tree=None, cos_dec=None, workers=-1,
+                  src_scaled_buf=None):
 
     """
 
@@ -82,16 +170,31 @@ def count_matches(src_cat, ref_cat,
     # matching_radius = 1./60. # 1 arcmin
 
     # Fix the cos(declination) problem
-    max_declination = numpy.max(numpy.fabs(src_cat[:,1]))
-    if (max_declination > 85): max_declination = 85
-    cos_dec = math.cos(math.radians(max_declination))
-    ref_cat = ref_cat.copy()
-    ref_cat[:,0] *= cos_dec
-    src_cat = src_cat.copy()
-    src_cat[:,0] *= cos_dec
-    
-    logger.debug("Creating ref KDtree")
-    ref_tree = scipy.spatial.cKDTree(ref_cat)
+    if (cos_dec is None):
+        max_declination = numpy.max(numpy.fabs(src_cat[:,1]))
+        if (max_declination > 85): max_declination = 85
+        cos_dec = math.cos(math.radians(max_declination))
+
+    # Scale the two coordinate columns into a scratch buffer - callers
+    # looping over many angles pass in a pre-allocated buffer that gets
+    # reused, avoiding one full catalog copy per trial angle
+    if (src_scaled_buf is None):
+        src_scaled_buf = numpy.empty(shape=(src_cat.shape[0], 2))
+    numpy.multiply(src_cat[:,0], cos_dec, out=src_scaled_buf[:,0])
+    src_scaled_buf[:,1] = src_cat[:,1]
+    src_cat = src_scaled_buf
+
+    #
+    # The reference catalog/tree is identical for all trial angles, so
+    # callers iterating over angles (find_best_guess) build it only once
+    # and pass it in. If we didn't get one, create it here.
+    # Note: a pre-built ref_tree implies ref_cat is already cos_dec-scaled.
+    #
+    if (ref_tree is None):
+        logger.debug("Creating ref KDtree")
+        ref_cat = ref_cat.copy()
+        ref_cat[:,0] *= cos_dec
+        ref_tree = scipy.spatial.cKDTree(ref_cat, **kdtree_opts)
 
 
     # print "\n\n\nIn count_matches:"
@@ -104,6 +207,8 @@ def count_matches(src_cat, ref_cat,
     #
     grid_size = int(pointing_error * 3600 * 2 + 1)
     count_grid_2d = numpy.zeros((grid_size, grid_size))#, dtype=numpy.int)
+    xedges = yedges = numpy.linspace(-pointing_error*3600, pointing_error*3600,
+                                     grid_size+1)
 
     idx_x, idx_y = numpy.indices(count_grid_2d.shape)
     idx_x -= (grid_size-1)//2
@@ -129,87 +234,41 @@ def count_matches(src_cat, ref_cat,
         # Get this chunk of the catalog
         src_chunk = src_cat[chunk*chunksize:(chunk+1)*chunksize, :]
 
-        # logger.info("Creating src KDtree")
-        src_tree = scipy.spatial.cKDTree(src_chunk)
-
         #
         # First create a catalog of nearby reference stars for each source star
         #
         # find all matches
-        # logger.info("Running ball_tree query")
-        matches = src_tree.query_ball_tree(ref_tree, pointing_error, p=2)
-
-        # also count how many matches in total we have found
-        # logger.info("counting all neighbors")
-        n_matches = src_tree.count_neighbors(ref_tree, pointing_error, p=2)
-
-        # Allocate memory to hold all offsets between src and reference catalog
-        all_offsets = numpy.zeros(shape=(n_matches,2))
-        cur_pair = 0
-
-        # dummy = open("ccmatch.offsets.%d" % int(round((debugangle*60),0)), "w")
-        # logger.info("assembling entire catalog (%d)" % (len(matches)))
-
+        # query_ball_point (unlike query_ball_tree) can run the query across
+        # multiple threads, and spares us building a tree for the chunk
+        matches = ref_tree.query_ball_point(src_chunk, pointing_error, p=2,
+                                            workers=workers)
 
-        for cur_src in range(len(matches)):
-            if (len(matches[cur_src]) <= 0):
-                continue
-
-
-            #if (verbose): print "\n",cur_src
-            # print matches[cur_src]
-
-            #
-            # matches[cur_src] contains the indices of matching stars from 
-            # the reference catalog.
-            # So extract the actual coordinates of all nearby reference stars
-            #
-            cur_matches = numpy.array(ref_cat[matches[cur_src]])
-            #if (verbose): print cur_matches
-            # print cur_matches.shape
-
-            #
-            # Subtract the source position to get relative offsets
-            #
-            cur_matches -= src_chunk[cur_src]
-            #if (verbose): print cur_matches
-            #numpy.savetxt(dummy, cur_matches)
-            #print >>dummy, "\n\n\n\n\n"
-
-            #
-            # And add all offsets into the global offset registry
-            #
-            # for cur_refstar in range(len(matches[cur_src])):
-            #     all_offsets[cur_pair,:] = cur_matches[cur_refstar]
-            #     cur_pair += 1
-            all_offsets[cur_pair:cur_pair+cur_matches.shape[0], :] = cur_matches[:,:]
-            cur_pair += cur_matches.shape[0]
-
-            # #
-            # # Add the new found src-ref pairs to count grid
-            # #
-            # this_2d, xedges, yedges = numpy.histogram2d(cur_matches[:,0]*3600, cur_matches[:,1]*3600, 
-            #                                             bins=grid_size, 
-            #                                             range=[[-pointing_error*3600, pointing_error*3600],
-            #                                                    [-pointing_error*3600, pointing_error*3600]], 
-            #                                             normed=False, 
-            #                                             weights=None)
-            # count_grid_2d += this_2d
-
-            # all_offsets[cur_pair:cur_pair+len(matches[cur_src]), :] = cur_matches[matches[cur_src]]
-            # cur_pair += len(matches[cur_src])
-
-             #print "#matches for source",cur_src, "-->", len(matches[cur_src]), src_cat.shape[0], ref_cat.shape[0], this_2d.shape, numpy.sum(this_2d)
-            # sys.stdout.write(".")
-            # sys.stdout.flush()
-
-        this_2d, xedges, yedges = numpy.histogram2d(all_offsets[:,0]*3600, all_offsets[:,1]*3600, 
-                                                    bins=grid_size, 
-                                                    range=[[-pointing_error*3600, pointing_error*3600],
-                                                           [-pointing_error*3600, pointing_error*3600]], 
-                                                    normed=False, 
-                                                    weights=None)
-        count_grid_2d += this_2d.astype(numpy.float32)
+        #
+        # matches is a list of lists, holding for each source star the indices
+        # of all nearby reference stars. Flatten it into a pair of index
+        # arrays so we can compute all source-to-reference offsets in a
+        # single vectorized subtraction instead of looping over every source
+        # star in python. With numba available the offsets are computed and
+        # voted into the count grid in one compiled pass instead.
+        #
+        match_counts = numpy.fromiter((len(m) for m in matches),
+                                      dtype=numpy.intp, count=len(matches))
+        if (numpy.sum(match_counts) > 0):
+            ref_idx = numpy.concatenate(matches).astype(numpy.intp)
+            if (numba is not None):
+                _accumulate_offset_votes(ref_cat, src_chunk, ref_idx,
+                                         match_counts, count_grid_2d,
+                                         pointing_error*3600)
+            else:
+                src_idx = numpy.repeat(numpy.arange(len(matches)), match_counts)
+                all_offsets = ref_cat[ref_idx] - src_chunk[src_idx]
+                this_2d, xedges, yedges = numpy.histogram2d(all_offsets[:,0]*3600, all_offsets[:,1]*3600,
+                                                            bins=grid_size,
+                                                            range=[[-pointing_error*3600, pointing_error*3600],
+                                                                   [-pointing_error*3600, pointing_error*3600]],
+                                                            normed=False,
+                                                            weights=None)
+                count_grid_2d += this_2d.astype(numpy.float32)
         if (create_debug_files2): numpy.savetxt("cc_countgrid_%+0.3f_chunk%03d" % (debugangle, chunk), count_grid_2d)
 
         # print "all-offsets:", all_offsets.shape, count_grid_2d.shape
@@ -333,8 +392,11 @@ def count_matches(src_cat, ref_cat,
     n_matches = -1
     if (final_significance >= -3): #0):
         src_corrected = src_cat[:, 0:2] + (mean_peak_pos / 3600.) #(offset) * numpy.array([cos_dec, 1.])
-        corr_tree = scipy.spatial.cKDTree(src_corrected)
-        n_matches = corr_tree.count_neighbors(ref_tree, 2./3600., p=2) # match stars within 2 arcsec
+        # match stars within 2 arcsec - count them with a multi-threaded
+        # query instead of building a second tree for count_neighbors
+        n_matches = numpy.sum(ref_tree.query_ball_point(
+            src_corrected, 2./3600., p=2, return_length=True,
+            workers=workers))
 
     logger.debug("done with entire cat (% 7s): max=%8.4f mean=%8.4f std=%8.4f --> sigma=%8.4f #matches=% 6d #searched=% 6d" % (
         str(debugangle), _max, _mean, _std, final_significance, n_matches, n_searched))
@@ -342,10 +404,13 @@ def count_matches(src_cat, ref_cat,
     return offset, n_matches, n_searched, _max, _mean, _std
 
 
-def rotate_shift_catalog(src_cat, center, angle, shift=None, verbose = False):
+def rotate_shift_catalog(src_cat, center, angle, shift=None, verbose = False,
+                         cos_center_dec=None):
     """
 
-    Apply a rotation and shift to a catalog.
+    Apply a rotation and shift to a catalog. Callers invoking this
+    repeatedly with the same rotation center (e.g. fitting loops) can pass
+    a precomputed `cos_center_dec` to skip the per-call trig evaluation.
 
     """
     if (verbose):
@@ -355,11 +420,17 @@ def rotate_shift_catalog(src_cat, center, angle, shift=None, verbose = False):
         print("center =", center)
         print("src-cat=\n", src_cat[:3])
 
+    # Nothing to compute for the zero-rotation, zero-shift case (the
+    # common shift-only search path); still return a copy since callers
+    # are free to modify the result in place.
+    if (angle == 0. and shift is None):
+        return src_cat.copy()
+
     center_ra, center_dec = center
     # print center_ra, center_dec
 
-    src_rotated = numpy.zeros(shape=(src_cat.shape[0],2))
-    src_rel_to_center = src_cat[:,0:2] - [center_ra, center_dec] 
+    center_radec = numpy.array([center_ra, center_dec])
+    src_rel_to_center = src_cat[:,0:2] - center_radec
 
     # print "\n\n\nDuring rotation"
     # print "src-cat=\n",src_cat[:5,:]
@@ -368,48 +439,58 @@ def rotate_shift_catalog(src_cat, center, angle, shift=None, verbose = False):
 
     # angles are given in arcmin
     angle_rad = math.radians(angle)
+    cos_angle = math.cos(angle_rad)
+    sin_angle = math.sin(angle_rad)
     if (verbose): print("angle radians =",angle_rad)
 
     # print "in rot_shift: angle-rad=",angle_rad
 
     # Account for cos(declination)
-    src_rel_to_center[:,0] *= math.cos(math.radians(center_dec))
+    if (cos_center_dec is None):
+        cos_center_dec = math.cos(math.radians(center_dec))
+    src_rel_to_center[:,0] *= cos_center_dec
 
     if (verbose and shift is not None):
         print("@@@@ shift rotation")
         print("shift=", shift)
         print("angle=", angle*60, "arcmin")
-        print("X=",math.cos(angle_rad) * shift[0] - math.sin(angle_rad) * shift[1])
-        print("y=",math.sin(angle_rad) * shift[0] + math.cos(angle_rad) * shift[1])
+        print("X=",cos_angle * shift[0] - sin_angle * shift[1])
+        print("y=",sin_angle * shift[0] + cos_angle * shift[1])
 
-    # Apply rotation
-    src_rotated[:,0] \
-        = math.cos(angle_rad) * src_rel_to_center[:,0] \
-        - math.sin(angle_rad) * src_rel_to_center[:,1]
-    src_rotated[:,1] \
-        = math.sin(angle_rad) * src_rel_to_center[:,0] \
-        + math.cos(angle_rad) * src_rel_to_center[:,1] \
+    # Apply rotation - a single 2x2 matrix multiplication instead of four
+    # separate element-wise column operations with their temporaries
+    rotation_matrix = numpy.array([[cos_angle, -sin_angle],
+                                   [sin_angle,  cos_angle]])
+    src_rotated = src_rel_to_center.dot(rotation_matrix.T)
 
     # Fix cos(declination)
-    src_rotated[:,0] /= math.cos(math.radians(center_dec))
+    src_rotated[:,0] /= cos_center_dec
 
     # Add center position
-    src_rotated += [center_ra, center_dec]
+    src_rotated += center_radec
 
     # if requested, add shift
     if (not type(shift) == type(None)):
         src_rotated += shift
     
-    if (verbose): 
+    if (verbose):
         print("src_rotated=\n", src_rotated[:3,0:2])
         print("src-final=\n", src_rotated[:3],"\n\n\n")
 
-    src_output = src_cat.copy()
-    src_output[:,0:2] = src_rotated[:,0:2]
+    # For pure coordinate catalogs the rotated array already is the final
+    # result; for wider catalogs assemble the output in a single pass
+    # instead of copying the full catalog and then overwriting Ra/Dec.
+    if (src_cat.shape[1] == 2):
+        return src_rotated
+
+    src_output = numpy.empty_like(src_cat)
+    src_output[:,0:2] = src_rotated
+    src_output[:,2:] = src_cat[:,2:]
 
     return src_output
 
-def kd_match_catalogs(src_cat, ref_cat, matching_radius, max_count=1):
+def kd_match_catalogs(src_cat, ref_cat, matching_radius, max_count=1,
+                      ref_tree=None):
     """
 
     Match two catalogs using kD-trees.
@@ -433,6 +514,12 @@ def kd_match_catalogs(src_cat, ref_cat, matching_radius, max_count=1):
 
         Exclude all sources that have more than (max_count) matches.
 
+    ref_tree : cKDTree
+
+        Optional kD-tree built from the (scaled) reference catalog.
+        Callers matching against the same reference catalog repeatedly
+        can build the tree once and reuse it across all calls.
+
     Returns
     -------
 
@@ -445,50 +532,53 @@ def kd_match_catalogs(src_cat, ref_cat, matching_radius, max_count=1):
 
     """
     
-    src_cat = src_cat.copy()
-    ref_cat = ref_cat.copy()
-    max_declination = numpy.max(numpy.fabs(ref_cat[:,1]))
-    if (max_declination > 85): max_declination = 85
-    cos_dec = math.cos(math.radians(max_declination))
-    src_cat[:,0] *= cos_dec
-    ref_cat[:,0] *= cos_dec
+    # Either catalog may arrive pre-scaled as a ScaledCatalog - in that
+    # case adopt its cos_dec and skip the redundant copy+scale pass here
+    if (isinstance(ref_cat, ScaledCatalog)):
+        cos_dec = ref_cat.cos_dec
+        ref_cat = ref_cat.data
+    else:
+        max_declination = numpy.max(numpy.fabs(ref_cat[:,1]))
+        if (max_declination > 85): max_declination = 85
+        cos_dec = math.cos(math.radians(max_declination))
+        ref_cat = ref_cat.copy()
+        ref_cat[:,0] *= cos_dec
+
+    if (isinstance(src_cat, ScaledCatalog)):
+        src_cat = src_cat.data
+    else:
+        src_cat = src_cat.copy()
+        src_cat[:,0] *= cos_dec
 
-    src_tree = scipy.spatial.cKDTree(src_cat[:,0:2])
-    ref_tree = scipy.spatial.cKDTree(ref_cat[:,0:2])
+    if (ref_tree is None):
+        ref_tree = scipy.spatial.cKDTree(ref_cat[:,0:2], **kdtree_opts)
 
     # print src_cat[0:5]
     # print ref_cat[0:5]
 
-    # Create an array to hold the matched catalog
-    output_cat = numpy.empty(shape=(src_cat.shape[0], src_cat.shape[1]+ref_cat.shape[1]))
-    # and insert the source catalog
     n_src_columns = src_cat.shape[1]
-    output_cat[:,0:n_src_columns] = src_cat
-
-    # print output_cat[0:5]
 
-    # also create an array holding for which sources we found a match
-    match_found = numpy.zeros(shape=(src_cat.shape[0]))
-
-    # match the catalogs using a kD-tree
-    match_indices = src_tree.query_ball_tree(ref_tree, matching_radius, p=2)
+    #
+    # Match the catalogs with a k-nearest query spread across all cores:
+    # a source passes the max_count criterion exactly if its nearest
+    # reference star is within the matching radius but its
+    # (max_count+1)-closest one is not. This never materializes the
+    # per-source neighbor lists the ball query would return.
+    #
+    match_dist, match_idx = ref_tree.query(src_cat[:,0:2],
+                                           k=max_count+1, workers=-1)
+    keep_idx = numpy.flatnonzero((match_dist[:,0] <= matching_radius) &
+                                 (match_dist[:,max_count] > matching_radius))
 
-    # print src_tree.count_neighbors(ref_tree, matching_radius, p=2)
+    # For each surviving source, pick its closest matching reference star
+    first_match = match_idx[keep_idx, 0]
 
-    # Now loop over all matches and merge the found matches
-    for cur_src in range(src_cat.shape[0]):
-
-        # Determine how many reference stars are close to this source
-        # Do not keep match if none or too many reference stars are nearby
-        n_matches = len(match_indices[cur_src])
-        if (n_matches <= 0 or n_matches > max_count):
-            continue
-    
-        output_cat[cur_src, n_src_columns:] = ref_cat[match_indices[cur_src][0]]
-        match_found[cur_src] = 1
-
-    # Now eliminate all sources without matches
-    final_cat = output_cat[match_found == 1]
+    # Assemble the matched catalog with two vectorized fills instead of
+    # merging row-by-row in python
+    final_cat = numpy.empty(shape=(keep_idx.shape[0],
+                                   src_cat.shape[1]+ref_cat.shape[1]))
+    final_cat[:, 0:n_src_columns] = src_cat[keep_idx]
+    final_cat[:, n_src_columns:] = ref_cat[first_match]
 
     # Reverse the cos_declination fix from above
     final_cat[:,0] /= cos_dec
@@ -498,51 +588,110 @@ def kd_match_catalogs(src_cat, ref_cat, matching_radius, max_count=1):
 
 
 
-def count_matches_parallelwrapper(work_queue, return_queue,
-                                  src_cat, ref_cat, 
-                                  center_ra, center_dec,
-                                  pointing_error=(max_pointing_error/60.), 
-                                  matching_radius=(4./3600.), 
-                                  debugangle=None
-                                  ):
+def share_catalog(catalog):
     """
-    
-    Just a small wrapper to enable parallel execution of `count_matches`.
+
+    Copy a catalog into a shared-memory block so worker processes can map
+    it directly instead of receiving a pickled copy each. Returns the
+    SharedMemory handle (the caller must close+unlink it after the workers
+    are done) and a small (name, shape, dtype) descriptor to pass to the
+    workers.
 
     """
+    shm = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=catalog.nbytes)
+    view = numpy.ndarray(catalog.shape, dtype=catalog.dtype, buffer=shm.buf)
+    view[:] = catalog
+    return shm, (shm.name, catalog.shape, catalog.dtype.str)
 
-    logger = logging.getLogger("ParCountMatch")
-    while (True):
-        task = work_queue.get()
-        if (task is None):
-            break
 
-        angle_id, angle = task
+def attach_shared_catalog(descriptor):
+    """
 
-        logger.debug("Starting work on angle %f deg / %f arcmin" % (angle,angle*60))
-        # print "Starting work on angle",angle,angle*60,"(deg/arcmin)"
+    Counterpart to `share_catalog`: re-construct a numpy view of a shared
+    catalog inside a worker process. Returns the SharedMemory handle (which
+    has to stay alive as long as the view is used) and the view itself.
 
-        src_rotated = rotate_shift_catalog(src_cat, (center_ra, center_dec), angle, None)
+    """
+    name, shape, dtype = descriptor
+    shm = multiprocessing.shared_memory.SharedMemory(name=name)
+    return shm, numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
 
-        # print "Angle:",angle*60.," --> ",
-        
-        #logger.debug("angle=%s src=%d ref=%d" % (angle, src_rotated.shape[0], ref_cat.shape[0]))
-        cm_data = count_matches(src_rotated, ref_cat, 
-                                pointing_error=pointing_error, 
-                                matching_radius=matching_radius,
-                                debugangle=angle)
 
-        if (create_debug_files):
-            offset, final_significance, n_searched, _max, _mean, _std = cm_data
-            numpy.savetxt("ccmatch.cat%f" % (angle*60), src_rotated)
-            # print angle*60,offset
-            matched_cat = kd_match_catalogs(src_rotated[:,0:2]+offset, ref_cat[:,0:2], matching_radius, max_count=1)
-            numpy.savetxt("ccmatch.matched_%f" % (angle*60), matched_cat)
+#
+# Per-worker state for the parallel angle sweep in find_best_guess. The
+# catalogs and the pre-built reference tree are handed to each worker once
+# via the Pool initializer, so only the tiny (angle_id, angle) tasks are
+# pickled per angle.
+#
+_fbg_worker_data = {}
 
-        return_queue.put((angle_id, cm_data))
-        work_queue.task_done()
+def count_matches_pool_init(src_rotated_shared, ref_cat,
+                            ref_cat_scaled_shared, ref_tree, cos_dec,
+                            pointing_error, matching_radius):
+    """
 
-    return
+    Pool initializer for the parallel execution of `count_matches`; stashes
+    all per-sweep constants in module-globals of the worker process. The
+    pre-rotated source stack and the reference catalog arrive as
+    shared-memory descriptors and are mapped, not copied.
+
+    """
+    shm_src, src_rotated = attach_shared_catalog(src_rotated_shared)
+    shm_ref, ref_cat_scaled = attach_shared_catalog(ref_cat_scaled_shared)
+    # keep the SharedMemory handles alive for the lifetime of the worker
+    _fbg_worker_data['shm'] = (shm_src, shm_ref)
+    _fbg_worker_data['src_rotated'] = src_rotated
+    _fbg_worker_data['ref_cat'] = ref_cat
+    _fbg_worker_data['ref_cat_scaled'] = ref_cat_scaled
+    _fbg_worker_data['ref_tree'] = ref_tree
+    _fbg_worker_data['cos_dec'] = cos_dec
+    _fbg_worker_data['pointing_error'] = pointing_error
+    _fbg_worker_data['matching_radius'] = matching_radius
+    # scratch buffer for the cos(dec)-scaled source coordinates, reused
+    # across all angles handled by this worker
+    _fbg_worker_data['src_scaled_buf'] = numpy.empty(
+        shape=(src_rotated.shape[1], 2))
+
+
+def count_matches_one_angle(task):
+    """
+
+    Process a single trial angle inside a Pool worker, using the constants
+    set up by `count_matches_pool_init`.
+
+    """
+
+    logger = logging.getLogger("ParCountMatch")
+
+    angle_id, angle = task
+    wd = _fbg_worker_data
+
+    logger.debug("Starting work on angle %f deg / %f arcmin" % (angle,angle*60))
+
+    # the parent already rotated the source catalog for all angles in one
+    # batched operation, so just pick out our slice
+    src_rotated = wd['src_rotated'][angle_id]
+
+    # workers=1: the angles are already processed in parallel, so don't
+    # additionally fan out each tree query across all cores
+    cm_data = count_matches(src_rotated, wd['ref_cat_scaled'],
+                            pointing_error=wd['pointing_error'],
+                            matching_radius=wd['matching_radius'],
+                            debugangle=angle,
+                            ref_tree=wd['ref_tree'], cos_dec=wd['cos_dec'],
+                            workers=1,
+                            src_scaled_buf=wd['src_scaled_buf'])
+
+    if (create_debug_files):
+        offset, final_significance, n_searched, _max, _mean, _std = cm_data
+        numpy.savetxt("ccmatch.cat%f" % (angle*60), src_rotated)
+        # print angle*60,offset
+        matched_cat = kd_match_catalogs(src_rotated[:,0:2]+offset, wd['ref_cat'][:,0:2],
+                                        wd['matching_radius'], max_count=1)
+        numpy.savetxt("ccmatch.matched_%f" % (angle*60), matched_cat)
+
+    return (angle_id, cm_data)
 
 def find_best_guess(src_cat, ref_cat,
                     center_ra, center_dec,
@@ -603,12 +752,25 @@ def find_best_guess(src_cat, ref_cat,
     
     """
 
-    # 
+    #
     # Now loop over all stars in the source catalog and find nearby stars in the reference catalog
     # Use a rather large matching radius for this step
     #
     #matching_radius = 1./60. # 1 arcmin
-    ref_tree = scipy.spatial.cKDTree(ref_cat)
+
+    #
+    # The reference catalog is the same for every trial angle (only the
+    # source catalog is rotated), so fix the cos(declination) problem and
+    # build the reference kD-tree only once here instead of once per angle
+    # inside count_matches.
+    #
+    max_declination = numpy.max([numpy.max(numpy.fabs(src_cat[:,1])),
+                                 numpy.max(numpy.fabs(ref_cat[:,1]))])
+    if (max_declination > 85): max_declination = 85
+    cos_dec = math.cos(math.radians(max_declination))
+    ref_cat_scaled = ref_cat.copy()
+    ref_cat_scaled[:,0] *= cos_dec
+    ref_tree = scipy.spatial.cKDTree(ref_cat_scaled, **kdtree_opts)
 
     #angle_max = 2.
     #d_angle = 5.
@@ -638,78 +800,78 @@ def find_best_guess(src_cat, ref_cat,
         print("in find_best_guess, angle_max =",angle_max)
         sys.exit(0)
 
+    #
+    # Rotate the source catalog for all trial angles in one batched
+    # operation: stack the (n_angles, 2, 2) rotation matrices and apply
+    # them with a single einsum call. This replaces one python-level
+    # rotate_shift_catalog call per angle with one matrix multiplication
+    # for the entire sweep.
+    #
+    angles_rad = numpy.radians(all_results[:,0])
+    cos_a = numpy.cos(angles_rad)
+    sin_a = numpy.sin(angles_rad)
+    rot_matrices = numpy.empty(shape=(n_angles, 2, 2))
+    rot_matrices[:,0,0] = cos_a
+    rot_matrices[:,0,1] = -sin_a
+    rot_matrices[:,1,0] = sin_a
+    rot_matrices[:,1,1] = cos_a
+    center_radec = numpy.array([center_ra, center_dec])
+    cos_center_dec = math.cos(math.radians(center_dec))
+    src_rel = src_cat[:,0:2] - center_radec
+    src_rel[:,0] *= cos_center_dec
+    src_rotated_all = numpy.einsum('aij,nj->ani', rot_matrices, src_rel)
+    src_rotated_all[:,:,0] /= cos_center_dec
+    src_rotated_all += center_radec
 
     if (allow_parallel):
 
-        processes = []
-        queue = multiprocessing.JoinableQueue()
-        queue._start_thread()
-        queue._thread.name = "QueueFeederThread_FindBestGuess_Jobs"
-
-        return_queue = multiprocessing.Queue()
-        return_queue._start_thread()
-        return_queue._thread.name = "QueueFeederThread_FindBestGuess_Results"
-
-        # Feed all angles to check into the queue
-        for cur_angle in range(n_angles):
-            angle = all_results[cur_angle,0]
-            queue.put((cur_angle, angle))
-
-        # worker_args = (queue, return_queue,
-        #                src_cat, ref_cat, center_ra, center_dec,
-        #                matching_radius,
-        #                fine_radius, 
-        #                angle)
-        worker_args = {
-            "work_queue": queue, 
-            "return_queue": return_queue,
-            "src_cat": src_cat, 
-            "ref_cat": ref_cat, 
-            "center_ra": center_ra, 
-            "center_dec": center_dec,
-            "pointing_error": pointing_error,
-            "matching_radius": matching_radius,
-            "debugangle": None,
-        }
-                                  
-
         number_cpus = sitesetup.number_cpus
         logger.debug("Running ccmatch on %d CPUs, hold on ..." % (number_cpus))
-        for i in range(number_cpus):
-            p = multiprocessing.Process(target=count_matches_parallelwrapper, kwargs=worker_args)
-            p.start()
-            processes.append(p)
-
-            # Also send a quit signal to each process
-            queue.put(None)
-        
-        # And finally, collect all results
-        for i in range(n_angles):
-
-            returned = return_queue.get()
-            # cur_angle, n_matches, offset = returned
-            cur_angle, cm_data = returned
-            offset, n_matched, n_searched, _max, _mean, _std = cm_data
-
-            # Compute number of real matches as the fraction of stars
-            #n_matched = (_max - _mean) / n_searched
-            #if (final_significance < 0): n_matched = 0
-
-            all_results[cur_angle,1:3] = offset
-            all_results[cur_angle,3] = n_matched
-
-        # Join all processes to make sure they terminate alright 
-        # without leaving zombie processes behind.
-        for p in processes:
-            p.join()
 
         #
+        # Use a worker Pool with an initializer so the catalogs and the
+        # reference tree are shipped to each worker only once; the per-angle
+        # tasks are just (angle_id, angle) tuples.
+        #
+        tasks = [(cur_angle, all_results[cur_angle,0])
+                 for cur_angle in range(n_angles)]
+
         #
+        # Put the pre-rotated source stack and the reference catalog into
+        # shared memory so each worker maps them instead of receiving its
+        # own pickled copy. The un-scaled reference catalog is only needed
+        # for debug dumps, so only ship it when those are enabled.
         #
-        queue.close()
-        queue.join_thread()
-        return_queue.close()
-        return_queue.join_thread()
+        shm_src, src_rotated_shared = share_catalog(src_rotated_all)
+        shm_ref, ref_cat_scaled_shared = share_catalog(ref_cat_scaled)
+        initargs = (src_rotated_shared,
+                    ref_cat if create_debug_files else None,
+                    ref_cat_scaled_shared, ref_tree, cos_dec,
+                    pointing_error, matching_radius)
+
+        pool = multiprocessing.Pool(processes=number_cpus,
+                                    initializer=count_matches_pool_init,
+                                    initargs=initargs)
+        try:
+            chunksize = max(1, n_angles // (4*number_cpus))
+            for returned in pool.imap_unordered(count_matches_one_angle,
+                                                tasks, chunksize=chunksize):
+                cur_angle, cm_data = returned
+                offset, n_matched, n_searched, _max, _mean, _std = cm_data
+
+                # Compute number of real matches as the fraction of stars
+                #n_matched = (_max - _mean) / n_searched
+                #if (final_significance < 0): n_matched = 0
+
+                all_results[cur_angle,1:3] = offset
+                all_results[cur_angle,3] = n_matched
+        finally:
+            pool.close()
+            pool.join()
+            shm_src.close()
+            shm_src.unlink()
+            shm_ref.close()
+            shm_ref.unlink()
 
     else:
 
@@ -719,13 +881,14 @@ def find_best_guess(src_cat, ref_cat,
             logger.debug("Starting work on angle %f deg / %f arcmin" % (angle,angle*60))
             # print "Starting work on angle",angle,angle*60,"(deg/arcmin)"
 
-            src_rotated = rotate_shift_catalog(src_cat, (center_ra, center_dec), angle, None)
+            src_rotated = src_rotated_all[cur_angle]
 
             logger.debug("Angle: %f -->" % (angle*60.))
-            n_matches, offset = count_matches(src_rotated, ref_cat, 
-                                              pointing_error=pointing_error, 
+            n_matches, offset = count_matches(src_rotated, ref_cat_scaled,
+                                              pointing_error=pointing_error,
                                               matching_radius=matching_radius,
-                                              debugangle=angle)
+                                              debugangle=angle,
+                                              ref_tree=ref_tree, cos_dec=cos_dec)
 
             if (create_debug_files):
                 numpy.savetxt("ccmatch.cat%f" % (angle*60), src_rotated)
@@ -854,9 +1017,10 @@ def fit_best_rotation_shift(src_cat, ref_cat,
     #
     logger.debug("Matching catalogs")
 
-    ref_tree = scipy.spatial.cKDTree(ref_cat_cosdec)
-    src_tree = scipy.spatial.cKDTree(src_rotated)
-    matched_src_ref_idx = src_tree.query_ball_tree(ref_tree, matching_radius, p=2)
+    ref_tree = scipy.spatial.cKDTree(ref_cat_cosdec, **kdtree_opts)
+    matched_src_ref_idx = ref_tree.query_ball_point(src_rotated,
+                                                    matching_radius, p=2,
+                                                    workers=-1)
 
     src_ref_pairs = numpy.ones(shape=(src_rotated.shape[0],4))
     src_ref_pairs[:,0:2] = src_rotated[:,0:2]
@@ -889,12 +1053,17 @@ def fit_best_rotation_shift(src_cat, ref_cat,
     logger.debug("Initial guess (angle, dx, dy): %s" % (str(p_init)))
 
 
+    # the rotation center is fixed for the entire fit, so evaluate its
+    # cos(dec) only once instead of in every residual call
+    cos_center_dec = math.cos(math.radians(center_dec))
+
     # This is the function that computes the errors
     # This is operating on real Ra/Dec data, so correct for cos(declination)
     def difference_source_reference_cat(p, src_cat, ref_cat, center, for_fitting=False):
-        src_rotated = rotate_shift_catalog(src_cat, center, 
-                                           angle=p[0], 
-                                           shift=p[1:3])
+        src_rotated = rotate_shift_catalog(src_cat, center,
+                                           angle=p[0],
+                                           shift=p[1:3],
+                                           cos_center_dec=cos_center_dec)
         diff = src_rotated - ref_cat
         diff[:,0] *= numpy.cos(numpy.radians(ref_cat[:,1]))
         if (for_fitting):
@@ -902,7 +1071,33 @@ def fit_best_rotation_shift(src_cat, ref_cat,
 
         return diff
 
-    # 
+    # The model is simple enough for an analytic Jacobian: this saves the
+    # fitter one extra residual evaluation per parameter and iteration that
+    # the forward-difference estimate would cost, and converges in fewer
+    # iterations since the derivatives are exact.
+    def difference_jacobian(p, src_cat, ref_cat, center, for_fitting=True):
+        center_ra, center_dec = center
+        cos_cd = cos_center_dec
+        rel_x = (src_cat[:,0] - center_ra) * cos_cd
+        rel_y = src_cat[:,1] - center_dec
+        angle_rad = math.radians(p[0])
+        cos_a = math.cos(angle_rad)
+        sin_a = math.sin(angle_rad)
+        # the Ra-residuals carry the same cos(dec) weight as in the
+        # residual function above
+        weight_x = numpy.cos(numpy.radians(ref_cat[:,1]))
+
+        jac = numpy.zeros(shape=(2*src_cat.shape[0], 3))
+        # d/d angle, converted from per-radian to per-degree
+        jac[0::2,0] = (-sin_a*rel_x - cos_a*rel_y) / cos_cd \
+                      * (math.pi/180.) * weight_x
+        jac[1::2,0] = (cos_a*rel_x - sin_a*rel_y) * (math.pi/180.)
+        # d/d dx and d/d dy are just the shift
+        jac[0::2,1] = weight_x
+        jac[1::2,2] = 1.
+        return jac
+
+    #
     # Eliminate all source stars without nearby/unique 
     # match in the reference catalog
     #
@@ -916,12 +1111,13 @@ def fit_best_rotation_shift(src_cat, ref_cat,
         numpy.savetxt("ccm.matched_src", matched_src)
         numpy.savetxt("ccm.matched_ref", matched_ref)
 
-    fit = scipy.optimize.leastsq(difference_source_reference_cat, 
-                                 p_init, 
-                                 args=args, 
-                                 full_output=1)
+    fit = scipy.optimize.least_squares(difference_source_reference_cat,
+                                       p_init,
+                                       jac=difference_jacobian,
+                                       method='lm',
+                                       args=args)
 
-    best_fit = fit[0]
+    best_fit = fit.x
 
     logger.debug("optimized parameters: " + str(best_fit))
 
@@ -934,8 +1130,8 @@ def fit_best_rotation_shift(src_cat, ref_cat,
     # best_shift_rotation_solution = fit[0]
 
 
-    diff_afterfit = difference_source_reference_cat(fit[0], 
-                                                    matched_src, 
+    diff_afterfit = difference_source_reference_cat(best_fit,
+                                                    matched_src,
                                                     matched_ref, 
                                                     center_radec, 
                                                     for_fitting=False)
@@ -960,22 +1156,20 @@ def optimize_shift_rotation(p, guessed_match, hdulist, fitting=True):
 
     diff = numpy.zeros(shape=(guessed_match.shape[0],2))
 
-    n_start = 0
-
     for ext in range(3): #len(hdulist)):
         if (not is_image_extension(hdulist[ext])):
             continue
 
         ota_extension = hdulist[ext]
         ota = int(ota_extension.header['FPPOS'][2:4])
-        
+
         # sources from this OTA
         in_this_ota = (guessed_match[:,8] == ota)
-        number_src_in_this_ota = numpy.sum(in_this_ota)
-        # print number_src_in_this_ota
-        if (number_src_in_this_ota <= 0):
+        if (numpy.sum(in_this_ota) <= 0):
             continue
 
+        # Extract only the stars in this OTA -
+        # only for these is the WCS solution applicable
         ota_cat = guessed_match[in_this_ota]
 
         # Read the WCS imformation from the fits file
@@ -991,24 +1185,15 @@ def optimize_shift_rotation(p, guessed_match, hdulist, fitting=True):
         # hdr['CTYPE2'] = 'DEC--TPN'
         # wcs = astWCS.WCS(hdr, mode='pyfits')
         # ra_dec = numpy.array(wcs.pix2wcs(ota_cat[:,2], ota_cat[:,3]))
-        # print ra_dec.shape, number_src_in_this_ota
-
-        # Extract only the stars in this OTA - 
-        # only for these is the WCS solution applicable
-        ota_cat = guessed_match[in_this_ota]
 
         # Convert pixel coordinates into Ra/Dec
         ra_dec = wcs_pix2wcs(ota_cat[:,2:4], wcs_poly, False)
 
-
-        
-        # And compute the offset between ODI and reference catalog
-        ota_diff = ra_dec - ota_cat[:,0:2] #ota_cat[:,-2:]
-
-        # and save differences until we have all of them
-        diff[n_start:n_start+number_src_in_this_ota] = ota_diff
-        
-        n_start += number_src_in_this_ota
+        # Compute the offset between ODI and reference catalog, and
+        # scatter it back via the OTA mask - this keeps every difference
+        # aligned with its row in the input catalog, independent of the
+        # order in which the extensions are traversed
+        diff[in_this_ota] = ra_dec - ota_cat[:,0:2] #ota_cat[:,-2:]
 
     if (not fitting):
         return diff
@@ -1034,8 +1219,6 @@ def verify_wcs_model(cat, hdulist):
     """
     comp = numpy.zeros(shape=(cat.shape[0],8))
 
-    n_start = 0
-
     for ext in range(len(hdulist)):
         if (not is_image_extension(hdulist[ext])):
             continue
@@ -1046,9 +1229,7 @@ def verify_wcs_model(cat, hdulist):
 
         # sources from this OTA
         in_this_ota = (cat[:,8] == ota)
-        number_src_in_this_ota = numpy.sum(in_this_ota)
-        # print number_src_in_this_ota
-        if (number_src_in_this_ota <= 0):
+        if (numpy.sum(in_this_ota) <= 0):
             continue
 
         # Read the WCS imformation from the fits file
@@ -1057,31 +1238,32 @@ def verify_wcs_model(cat, hdulist):
         # wcs_poly = wcs_clear_distortion(wcs_poly)
 
 
-        # Extract only the stars in this OTA - 
+        # Extract only the stars in this OTA -
         # only for these is the WCS solution applicable
         ota_cat = cat[in_this_ota]
         ota_cat[:,2:4] -= [1,1]
 
         # Convert pixel coordinates into Ra/Dec
         ra_dec = wcs_pix2wcs(ota_cat[:,2:4], wcs_poly)
-        
-        comp[n_start:n_start+number_src_in_this_ota,0:4] = ota_cat[:,0:4]
-        comp[n_start:n_start+number_src_in_this_ota,4:6] = ra_dec[:,0:2]
+
+        # scatter all results back via the OTA mask so each row of comp
+        # lines up with the corresponding row of the input catalog, no
+        # matter in what order the extensions are stored
+        comp[in_this_ota,0:4] = ota_cat[:,0:4]
+        comp[in_this_ota,4:6] = ra_dec[:,0:2]
 
         ota_extension.header['CTYPE1'] = 'RA---TPV'
         ota_extension.header['CTYPE2'] = 'DEC--TPV'
         wcs = astWCS.WCS(ota_extension.header, mode='pyfits')
         wcs2 = numpy.array(wcs.pix2wcs(ota_cat[:,2], ota_cat[:,3]))
-        
+
         #print wcs2.shape
         #print wcs2[0:4,0:2]
-        comp[n_start:n_start+number_src_in_this_ota,6:8] = wcs2[:,0:2]
+        comp[in_this_ota,6:8] = wcs2[:,0:2]
 
         dump_file = "debug.verifywcs."+extname
         print("writing",dump_file)
-        numpy.savetxt(dump_file, comp[n_start:n_start+number_src_in_this_ota,:])
-
-        n_start += number_src_in_this_ota
+        numpy.savetxt(dump_file, comp[in_this_ota,:])
 
     return comp
 
@@ -1141,23 +1323,91 @@ def optimize_wcs_solution(ota_cat, hdr, optimize_header_keywords):
             p_init[i] = 0.
 
     fit_args = (src_xy, ref_radec, astwcs, optimize_header_keywords)
-    fit = scipy.optimize.leastsq(minimize_wcs_error,
-                                 p_init, 
-                                 args=fit_args,
-                                 maxfev=1000,
-                                 full_output=1)
-
-    # New, optimized values are in fit[0]
-    better_wcs = fit[0]
-    # Copy the optimized values into the header
-    for i in range(len(optimize_header_keywords)):
-        hdr[optimize_header_keywords[i]] = better_wcs[i]
+    fit = scipy.optimize.least_squares(minimize_wcs_error,
+                                       p_init,
+                                       method='lm',
+                                       xtol=1e-10,
+                                       max_nfev=1000,
+                                       args=fit_args)
+
+    # New, optimized values are in fit.x
+    better_wcs = fit.x
+    # Copy the optimized values into the header in one batched update -
+    # every individual __setitem__ triggers a header card reflow
+    hdr.update(zip(optimize_header_keywords, better_wcs.tolist()))
 
     return p_init, better_wcs
 
 
 
 
+def tan_pix2wcs(crval1, crval2, cd, rel_xy):
+    """
+
+    Vectorized tangent-plane (gnomonic) de-projection: convert pixel
+    offsets relative to CRPIX into Ra/Dec for the given CRVAL and CD
+    matrix. This computes the same thing astWCS.pix2wcs does for a plain
+    TAN header, but on the entire coordinate array in a handful of numpy
+    operations instead of astLib's per-point python loop.
+
+    """
+    xi_eta = numpy.radians(rel_xy.dot(cd.T))
+    xi = xi_eta[:,0]
+    eta = xi_eta[:,1]
+    dec0 = math.radians(crval2)
+    den = math.cos(dec0) - eta * math.sin(dec0)
+    ra = math.radians(crval1) + numpy.arctan2(xi, den)
+    dec = numpy.arctan((math.sin(dec0) + eta*math.cos(dec0)) /
+                       numpy.hypot(xi, den))
+    return numpy.degrees(numpy.column_stack([ra, dec]))
+
+
+if (numba is not None):
+    @numba.njit(cache=True, fastmath=True)
+    def _tan_fit_residual(p, rel_xy, ref_radec, out):
+        """
+
+        Compiled version of the shear+position residual: tangent-plane
+        projection of all sources followed by the reference subtraction,
+        written into a caller-provided buffer. Avoids the python call
+        overhead and numpy temporaries of the interpreted residual for
+        the thousands of evaluations MINPACK makes per fit.
+
+        """
+        deg2rad = math.pi / 180.
+        crval1 = p[0] * deg2rad
+        dec0 = p[1] * deg2rad
+        sin_d0 = math.sin(dec0)
+        cos_d0 = math.cos(dec0)
+        for i in range(rel_xy.shape[0]):
+            xi = (p[2]*rel_xy[i,0] + p[3]*rel_xy[i,1]) * deg2rad
+            eta = (p[4]*rel_xy[i,0] + p[5]*rel_xy[i,1]) * deg2rad
+            den = cos_d0 - eta*sin_d0
+            ra = crval1 + math.atan2(xi, den)
+            dec = math.atan((sin_d0 + eta*cos_d0) / math.hypot(xi, den))
+            out[2*i]   = ra / deg2rad - ref_radec[i,0]
+            out[2*i+1] = dec / deg2rad - ref_radec[i,1]
+        return out
+
+    @numba.njit(cache=True, fastmath=True)
+    def _tan_fit_jacobian(p, rel_xy, jac):
+        """
+
+        Compiled counterpart of the analytic shear+position Jacobian,
+        filling a caller-provided (6, 2N) buffer (col_deriv layout).
+
+        """
+        cos_dec = math.cos(p[1] * math.pi / 180.)
+        for i in range(rel_xy.shape[0]):
+            jac[0, 2*i]   = 1.
+            jac[1, 2*i+1] = 1.
+            jac[2, 2*i]   = rel_xy[i,0] / cos_dec
+            jac[3, 2*i]   = rel_xy[i,1] / cos_dec
+            jac[4, 2*i+1] = rel_xy[i,0]
+            jac[5, 2*i+1] = rel_xy[i,1]
+        return jac
+
+
 def optimize_shear_and_position(ota_cat, hdr):
     """
 
@@ -1165,49 +1415,93 @@ def optimize_shear_and_position(ota_cat, hdr):
 
     """
 
-    # Create a astLib WCS class to handle the conversion from X/Y to Ra/Dec
-    astwcs = astWCS.WCS(hdr, mode='pyfits')
-
     keyword_order = ('CRVAL1', 'CRVAL2',
                      'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2')
 
-    def fit_shear_and_position(p, src_xy, ref_radec, astwcs):
-
-        # Transfer all fitting parameters to astWCS
-        for i in range(6):
-            astwcs.header[keyword_order[i]] = p[i]
-        # and update astWCS so the changes take effect
-        astwcs.updateFromHeader()
-
-        # Now compute all Ra/Dec values based on the new WCS solution
-        src_radec = numpy.array(astwcs.pix2wcs(src_xy[:,0], src_xy[:,1]))
+    #
+    # The residual evaluates the tangent-plane projection directly in
+    # numpy - no more per-iteration header writes, updateFromHeader
+    # re-parsing, or astLib's per-point pix2wcs loop.
+    #
+    def fit_shear_and_position(p, rel_xy, ref_radec):
+        cd = numpy.array([ [p[2], p[3]],
+                           [p[4], p[5]] ])
+        src_radec = tan_pix2wcs(p[0], p[1], cd, rel_xy)
 
-        # This gives us the Ra/Dec values as 2-d array
         # compute difference from the Ra/Dec of the reference system
-        src_ref = src_radec - ref_radec
-
-        # return the 1-d version for optimization
-        return src_ref.ravel()
+        # and return the 1-d version for optimization
+        return (src_radec - ref_radec).ravel()
 
-    # Prepare all values we need for fitting
-    src_xy = ota_cat[:,2:4] - [1.,1.]
-    ref_radec = ota_cat[:,-2:]
+    #
+    # Over a single OTA the tangent-plane WCS is, to excellent
+    # approximation, linear in all six fit parameters: Ra/Dec respond
+    # one-to-one to CRVAL, and the CD-matrix elements enter scaled by the
+    # pixel offset from CRPIX (with a cos(dec) factor on the Ra side).
+    # Providing this Jacobian analytically spares MINPACK six full
+    # projection round-trips per iteration for its forward-difference
+    # estimate.
+    #
+    def fit_shear_and_position_jacobian(p, rel_xy, ref_radec):
+        cos_dec = math.cos(math.radians(p[1]))
+        jac = numpy.zeros(shape=(2*rel_xy.shape[0], 6))
+        # d Ra / d CRVAL1 and d Dec / d CRVAL2
+        jac[0::2, 0] = 1.
+        jac[1::2, 1] = 1.
+        # d Ra / d CD1_1 / CD1_2
+        jac[0::2, 2] = rel_xy[:,0] / cos_dec
+        jac[0::2, 3] = rel_xy[:,1] / cos_dec
+        # d Dec / d CD2_1 / CD2_2
+        jac[1::2, 4] = rel_xy[:,0]
+        jac[1::2, 5] = rel_xy[:,1]
+        return jac
+
+    # Prepare all values we need for fitting; pixel coordinates are only
+    # ever used relative to the projection center. SExtractor centroids
+    # are only good to ~0.01 pixel anyway, so storing the relative pixel
+    # coordinates as float32 loses nothing but halves the bytes streamed
+    # through the projection kernel on every fit iteration - all further
+    # arithmetic promotes to float64 before the residual is formed.
+    rel_xy = (ota_cat[:,2:4] - [hdr['CRPIX1'], hdr['CRPIX2']]
+              ).astype(numpy.float32)
+    ref_radec = numpy.ascontiguousarray(ota_cat[:,-2:])
+
+    if (numba is not None):
+        # hand the fitter the compiled kernels instead; the buffers are
+        # freshly allocated per call since least_squares keeps references
+        # to returned arrays across iterations
+        def fit_shear_and_position(p, rel_xy, ref_radec):
+            out = numpy.empty(shape=(2*rel_xy.shape[0]))
+            return _tan_fit_residual(p, rel_xy, ref_radec, out)
+
+        def fit_shear_and_position_jacobian(p, rel_xy, ref_radec):
+            jac = numpy.zeros(shape=(6, 2*rel_xy.shape[0]))
+            return _tan_fit_jacobian(p, rel_xy, jac).T
 
     p_init = [0] * 6
     for i in range(6):
         p_init[i] = hdr[keyword_order[i]]
 
-    fit_args = (src_xy, ref_radec, astwcs)
-    fit = scipy.optimize.leastsq(fit_shear_and_position,
-                                 p_init, 
-                                 args=fit_args, 
-                                 full_output=1)
-
-    # New, optimized values are in fit[0]
-    better_wcs = fit[0]
-    # Copy the optimized values into the header
-    for i in range(6):
-        hdr[keyword_order[i]] = better_wcs[i]
+    fit_args = (rel_xy, ref_radec)
+    # Keep the CD matrix within loose physical bounds (a factor of two of
+    # the initial plate scale) so the fit cannot wander through
+    # near-singular configurations; CRVAL stays unconstrained
+    cd_scale = numpy.max(numpy.fabs(p_init[2:6]))
+    lower = [-numpy.inf, -numpy.inf] + [v - 2.*cd_scale for v in p_init[2:6]]
+    upper = [ numpy.inf,  numpy.inf] + [v + 2.*cd_scale for v in p_init[2:6]]
+
+    fit = scipy.optimize.least_squares(fit_shear_and_position,
+                                       p_init,
+                                       jac=fit_shear_and_position_jacobian,
+                                       method='trf',
+                                       bounds=(lower, upper),
+                                       xtol=1e-10,
+                                       args=fit_args)
+
+    # New, optimized values are in fit.x
+    better_wcs = fit.x
+    # Copy the optimized values into the header in one batched update -
+    # every individual __setitem__ triggers a header card reflow
+    hdr.update(zip(keyword_order, better_wcs.tolist()))
 
     return
 
@@ -1223,8 +1517,10 @@ def ccmatch_shift(source_cat,
 
     """
     if (center is None):
-        center_ra = numpy.median(source_cat[:,0])
-        center_dec = numpy.median(source_cat[:,1])
+        # Fallback only - callers that already know the field center (e.g.
+        # from CRVAL1/2) should pass it in; the O(N) medians are computed
+        # in a single call over both columns
+        center_ra, center_dec = numpy.median(source_cat[:,0:2], axis=0)
     else:
         center_ra, center_dec = center
 
@@ -1284,51 +1580,47 @@ def apply_correction_to_header(hdulist, best_guess, verbose=False):
     """
     logger = logging.getLogger("ApplyWCSCorrection")
 
-    for ext in range(len(hdulist)):
-        if (not is_image_extension(hdulist[ext])):
-            continue
-
-        ota_extension = hdulist[ext]
-        
-        # Read all WCS relevant information from the FITS header
+    headers = [hdulist[ext].header for ext in range(len(hdulist))
+               if is_image_extension(hdulist[ext])]
+    if (len(headers) == 0):
+        return
+
+    # The rotation matrix is identical for all extensions, so gather all
+    # CD matrices and CRVALs, apply the rotation as one batched matrix
+    # product and the shift as one vectorized addition, and write the
+    # results back - same math as the old per-extension version, with a
+    # single python pass over the extensions
+    angle_rad = numpy.radians(best_guess[0])
+    rot = numpy.array([ [+math.cos(angle_rad), -math.sin(angle_rad)],
+                        [+math.sin(angle_rad), +math.cos(angle_rad)] ])
+
+    cd_stack = numpy.array([ [[hdr['CD1_1'], hdr['CD1_2']],
+                              [hdr['CD2_1'], hdr['CD2_2']]]
+                             for hdr in headers ])
+    crval_stack = numpy.array([ [hdr['CRVAL1'], hdr['CRVAL2']]
+                                for hdr in headers ])
+
+    cd_rot = numpy.einsum('kij,jl->kil', cd_stack, rot)
+    crval_shifted = crval_stack + best_guess[1:3]
+
+    for i, hdr in enumerate(headers):
         logger.debug("Applying shift %f/%f and rotation %f deg to extension %s" % (
-            best_guess[1], best_guess[2], best_guess[0], ota_extension.header['EXTNAME']))
+            best_guess[1], best_guess[2], best_guess[0], hdr['EXTNAME']))
 
         if (verbose):
-            print(hdulist[ext].header['CRVAL1'], hdulist[ext].header['CRVAL2'])
-            hdulist[ext].header['XVAL1'] = hdulist[ext].header['CRVAL1']
-            hdulist[ext].header['XVAL2'] = hdulist[ext].header['CRVAL2']
-
-        # Get CD matrix
-        hdr = ota_extension.header
-        cd = numpy.array([ [hdr['CD1_1'], hdr['CD1_2']],
-                           [hdr['CD2_1'], hdr['CD2_2']] ])
-        angle_rad = numpy.radians(best_guess[0])
-        rot = numpy.array([ [+math.cos(angle_rad), -math.sin(angle_rad)],
-                            [+math.sin(angle_rad), +math.cos(angle_rad)] ])
-        # rot = numpy.array([ [+math.cos(angle_rad), +math.sin(angle_rad)],
-        #                     [-math.sin(angle_rad), +math.cos(angle_rad)] ])
-        cd_rot = cd.dot(rot)
-        hdulist[ext].header['CD1_1'] = cd_rot[0,0]
-        hdulist[ext].header['CD1_2'] = cd_rot[0,1]
-        hdulist[ext].header['CD2_1'] = cd_rot[1,0]
-        hdulist[ext].header['CD2_2'] = cd_rot[1,1]
-
-        # Now apply the offset in Ra/Dec
-        hdulist[ext].header['CRVAL1'] += best_guess[1]
-        hdulist[ext].header['CRVAL2'] += best_guess[2]
-
-        # # print hdulist[ext].header['CRVAL1'], hdulist[ext].header['CRVAL2']
-        # wcs_poly = header_to_polynomial(ota_extension.header)
-
-        # # Apply the shift and rotation
-        # wcs_poly = wcs_apply_shift(wcs_poly, best_guess[1:3])
-
-        # # Write the updated, WCS relevant keywords back to FITS header
-        # wcs_wcspoly_to_header(wcs_poly, hdulist[ext].header) #ota_extension.header)
+            print(hdr['CRVAL1'], hdr['CRVAL2'])
+            hdr['XVAL1'] = hdr['CRVAL1']
+            hdr['XVAL2'] = hdr['CRVAL2']
+
+        hdr.update((('CD1_1', cd_rot[i,0,0]),
+                    ('CD1_2', cd_rot[i,0,1]),
+                    ('CD2_1', cd_rot[i,1,0]),
+                    ('CD2_2', cd_rot[i,1,1]),
+                    ('CRVAL1', crval_shifted[i,0]),
+                    ('CRVAL2', crval_shifted[i,1])))
 
         if (verbose):
-            print(hdulist[ext].header['CRVAL1'], hdulist[ext].header['CRVAL2'])
+            print(hdr['CRVAL1'], hdr['CRVAL2'])
 
     return
 
@@ -1336,119 +1628,327 @@ def apply_correction_to_header(hdulist, best_guess, verbose=False):
 
 
 
-def pick_isolated_stars(catalog, radius=10.):
+def pick_isolated_stars(catalog, radius=10., kdtree=None):
     """
 
     Break down the catalog and eliminate all sources with nearby neighbors.
 
+    Callers probing several radii on the same catalog can pass in a
+    kD-tree built from catalog[:,0:2] once; only the query radius changes
+    between calls, so there is no need to rebuild the tree every time.
+
     """
 
-    kdtree = scipy.spatial.cKDTree(catalog[:,0:2])
+    if (kdtree is None):
+        kdtree = scipy.spatial.cKDTree(catalog[:,0:2], **kdtree_opts)
 
-    # Create an array holding for which sources we found a match
-    isolated = numpy.zeros(shape=(catalog.shape[0]))
-    
-    # match the catalogs using a kD-tree
+    # Count the number of nearby sources for each source in a single
+    # multi-threaded query - no need to materialize the per-source
+    # neighbor lists just to take their lengths.
+    #
+    # Keep in mind that each source has at least 1 nearby source: itself,
+    # so only neighbor counts > 1 count as having a real neighbor
     matching_radius = radius / 3600.
-    match_indices = kdtree.query_ball_tree(kdtree, matching_radius, p=2)
-    #match_count = kdtree.count_neighbors(kdtree, matching_radius, p=2)
+    neighbor_count = kdtree.query_ball_point(catalog[:,0:2],
+                                             matching_radius, p=2,
+                                             return_length=True, workers=-1)
 
-    # print match_count
+    # Now eliminate all sources with real neighbors
+    final_cat = catalog[neighbor_count <= 1]
 
-    # Now loop over all matches and merge the found matches
-    for cur_src in range(catalog.shape[0]):
+    return final_cat
 
-        # Determine how many reference stars are close to this source
-        # Do not keep match if none or too many reference stars are nearby
-        #
-        # Keep in mind that each source has at least 1 nearby source: itself
-        # so only neighbor counts > 1 count as having a real neighbor
-        n_matches = len(match_indices[cur_src])
-        if (n_matches <= 1):
-            isolated[cur_src] = 1
 
-        # print cur_src, catalog[cur_src, 0], catalog[cur_src,1], n_matches
-    
-    # Now eliminate all sources without matches
-    # final_cat = catalog[match_count < 1] #isolated == 1]
-    final_cat = catalog[isolated == 1]
 
-    return final_cat
+#
+# Worker pool for the per-OTA WCS optimization. The pool is created
+# lazily on first use and then kept alive for the rest of the run, so
+# pipelines calling improve_wcs_solution once per frame pay the process
+# startup cost only once instead of forking a fresh set of workers for
+# every frame.
+#
+_wcs_opt_pool = None
 
+def get_wcs_optimization_pool():
+    global _wcs_opt_pool
+    if (_wcs_opt_pool is None):
+        _wcs_opt_pool = multiprocessing.Pool(processes=sitesetup.number_cpus)
+    return _wcs_opt_pool
 
 
-def parallel_optimize_wcs_solution(queue_in, queue_out):
+def parallel_optimize_wcs_solution(task):
     """
 
     This is a minimal wrapper around optimize_wcs_solution to enable parallel
-    execution.
-
-    All input commands are received via a multiprocessing.JoinableQueue and 
-    reported back via a separate multiprocessing.Queue.
+    execution as a Pool task: optimize the WCS for one OTA and return the
+    updated catalog and header.
 
     """
 
     logger = logging.getLogger("ParallelOptimizeWCS")
 
-    while (True):
+    # Extract all necessary data from the task; the matched catalog lives
+    # in a shared-memory block, so only the row indices for this OTA plus
+    # the header have to be pickled per task
+    matched_descriptor, ota_rows, header, headers_to_optimize, extension_id = task
 
-        data_in = queue_in.get()
-        if (data_in is None):
-            logger.debug("Received end signal, shutting down")
-            queue_in.task_done()
-            return
-            
-        # Extract all necessary data from command queue
-        catalog, header, headers_to_optimize, extension_id = data_in
+    logger.debug("Starting work for OTA %s..." % (header['EXTNAME']))
 
-        logger.debug("Starting work for OTA %s..." % (header['EXTNAME']))
+    shm, matched_global = attach_shared_catalog(matched_descriptor)
+    catalog = matched_global[ota_rows]
+    shm.close()
 
-        optimize_wcs_solution(catalog, header, headers_to_optimize)
+    optimize_wcs_solution(catalog, header, headers_to_optimize)
 
-        # Now that we have the optimized WCS solution, recompute the source 
-        # Ra/Dec values with the better system
-        astwcs = astWCS.WCS(header, mode='pyfits')
+    logger.debug("Done with work for OTA %s..." % (header['EXTNAME']))
 
-        ota_xy = catalog[:,2:4] - [1.,1.]
-        ota_radec = numpy.array(astwcs.pix2wcs(ota_xy[:,0], ota_xy[:,1]))
+    # Only the updated header needs to travel back - the caller re-derives
+    # all source coordinates from the full catalog once all headers are in
+    return header, extension_id
 
-        catalog[:,0:2] = ota_radec
 
-        # Prepare and return results to main process
-        return_data = catalog, header, extension_id
-        queue_out.put(return_data)
-        queue_in.task_done()
-        logger.debug("Down with work for OTA %s..." % (header['EXTNAME']))
 
-    return
+def parallel_fit_ota_distortion(task):
+    """
+
+    Pool-task wrapper around the per-OTA distortion fit: derive the
+    improved distortion polynomial for one OTA and return it together with
+    the extension it belongs to. The task only carries the polynomial
+    tuple and this OTA's coordinate arrays - all plain numpy arrays that
+    pickle cheaply - and the caller writes the returned polynomials back
+    into the FITS headers serially once all fits are in.
+
+    """
+
+    ota, wcs_poly, ota_xy, ota_ref, ota_truth, extension_id = task
+
+    print("sources in ota %d = %s ..." % (ota, str(ota_xy.shape)))
+
+    xi, xi_r, eta, eta_r, cd, crval, crpix = wcs_poly
+    #numpy.savetxt(sys.stdout, xi, "%9.2e")
+    #numpy.savetxt(sys.stdout, xi_r, "%9.2e")
+
+    # wcs_poly = update_polynomial(wcs_poly,
+    #                              numpy.array([1.11, 2.22, 3.33, 4.44]),
+    #                              numpy.array([1.11, 2.22, 3.33, 4.44]),
+    #                              )
+
+    if (create_debug_files):
+        #
+        # Now with the updated header, compute ra,dec from x,y
+        #
+        ra_dec = wcs_pix2wcs(ota_xy, wcs_poly)
+
+        numpy.savetxt("ccmatch.true_radec.OTA%02d" % (ota), ota_truth)
+        numpy.savetxt("ccmatch.computed_radec.OTA%02d" % (ota), ra_dec)
+
+        # cross-check against the astWCS-based implementation; the poked
+        # constant term is skipped by wcs_wcspoly_to_header and must not
+        # show up in its output
+        xi[0,0] = 10000
+        wcs_poly2 = xi, xi_r, eta, eta_r, cd, crval, crpix
+        ra_dec2 = wcs_pix2wcs_2(ota_xy, wcs_poly2)
+        numpy.savetxt("ccmatch.computed_radec2.OTA%02d" % (ota), ra_dec2)
+
+    # sys.exit(0)
+
+    print()
+    #numpy.savetxt(sys.stdout, xi, "%9.2e")
+    #numpy.savetxt(sys.stdout, xi_r, "%9.2e")
+
+    def optimize_distortion(p, input_xy, input_ref, wcs_poly, fit=True):
+        n_params = p.shape[0] // 2
+        p_xi = p[:n_params]
+        p_eta = p[-n_params:]
+
+        wcs_poly_for_fit = update_polynomial(wcs_poly, p_xi, p_eta)
+
+        if (numba is not None):
+            # evaluate the distortion polynomials and de-projection
+            # in the compiled kernel - updating the small coefficient
+            # tables above stays in python, the O(N_stars) part runs
+            # without numpy temporaries
+            c_xi, c_xi_r, c_eta, c_eta_r, cd, crval, crpix = \
+                wcs_poly_for_fit
+            ra_dec_computed = numpy.empty(shape=(input_xy.shape[0], 2))
+            _distortion_pix2wcs(input_xy, c_xi, c_xi_r,
+                                c_eta, c_eta_r, cd, crval, crpix,
+                                ra_dec_computed)
+        else:
+            ra_dec_computed = wcs_pix2wcs(input_xy, wcs_poly_for_fit)
+        diff = input_ref - ra_dec_computed
+        if (not fit):
+            return diff
+        return diff.ravel()
+
+    #
+    # Determine initial guesses from the current wcs distortion
+    #
+    xi_1d, eta_1d = wcs_poly_to_arrays(wcs_poly)
+
+    # For now, let's optimize only the first 4 factors
+    n_free_parameters = 3 # or 4 or 7 or 12 or 17 or 24
+    p_init = numpy.append(xi_1d[:n_free_parameters], eta_1d[:n_free_parameters])
+    print(p_init)
+
+    print("ota-cat=\n",ota_xy)
+    print("ota-ref=\n",ota_ref)
+
+    if (create_debug_files):
+        # this residual evaluation only feeds the debug dump
+        diff = optimize_distortion(p_init, ota_xy, ota_ref, wcs_poly, fit=False)
+        numpy.savetxt("ccmatch.optimize_distortion_before_OTA%02d" % (ota), diff)
+
+    if (True):
+        print("\n\n\n\n\n\n\nStarting fitting\n\n\n\n\n")
+
+        # The polynomial basis only depends on the pixel
+        # coordinates and the fixed CD matrix, so it is computed
+        # once; the Jacobian is then analytic and the fitter no
+        # longer needs 2*n_params finite-difference residual
+        # evaluations per LM iteration
+        basis_xi, basis_eta, offset_xi, offset_eta = \
+            distortion_fit_basis(ota_xy, wcs_poly,
+                                 n_free_parameters)
+
+        # Both the residual and the Jacobian are specialized on the
+        # precomputed basis - evaluating either is a matrix-vector
+        # product plus the de-projection, with no polynomial-table
+        # update per call
+        def optimize_distortion_resid(p):
+            return distortion_fit_residual(
+                p, basis_xi, basis_eta, offset_xi, offset_eta,
+                wcs_poly[5], ota_ref)
+
+        def optimize_distortion_jac(p):
+            return distortion_fit_jacobian(
+                p, basis_xi, basis_eta, offset_xi, offset_eta,
+                wcs_poly[5])
+
+        # The residual is linear in the coefficients up to the
+        # gentle nonlinearity of the tangent-plane de-projection,
+        # so there is no need for a full LM optimizer: plain
+        # Gauss-Newton steps - one linear lstsq solve against the
+        # analytic Jacobian each - converge in one or two
+        # iterations (exactly one if the problem were strictly
+        # linear)
+        p_afterfit = numpy.asarray(p_init, dtype=numpy.float64)
+        resid = optimize_distortion_resid(p_afterfit)
+        cost = numpy.dot(resid, resid)
+        for iteration in range(10):
+            jac = optimize_distortion_jac(p_afterfit)
+            step = numpy.linalg.lstsq(jac, -resid, rcond=None)[0]
+            p_new = p_afterfit + step
+            resid_new = optimize_distortion_resid(p_new)
+            cost_new = numpy.dot(resid_new, resid_new)
+            if (not numpy.isfinite(cost_new) or cost_new > cost):
+                # diverging - keep the last good solution
+                break
+            p_afterfit, resid = p_new, resid_new
+            if (cost - cost_new <= 1e-12 * cost):
+                cost = cost_new
+                break
+            cost = cost_new
+
+        print("\n\n\n\n\n\n\nDone with fitting")
+        print(p_init)
+        print(p_afterfit)
+        print("\n\n\n\n\n")
+    else:
+        p_afterfit = p_init
+
+    if (create_debug_files):
+        # same here - only needed for the debug dump
+        diff_after = optimize_distortion(p_afterfit, ota_xy, ota_ref, wcs_poly, fit=False)
+        numpy.savetxt("ccmatch.optimize_distortion_after_OTA%02d" % (ota), diff_after)
+
+    wcs_poly_after_fit = update_polynomial(wcs_poly,
+                                           p_afterfit[:n_free_parameters],
+                                           p_afterfit[-n_free_parameters:]
+                                           )
+
+    return wcs_poly_after_fit, extension_id
+
+
+
+class WCSCache(object):
+    """
+
+    Small cache for astWCS.WCS objects. Constructing an astWCS.WCS parses
+    the full FITS header, and the same unchanged header is turned into a
+    WCS object several times per frame across improve_wcs_solution and
+    recompute_radec_from_xy. Entries are keyed by the identity of the
+    header object and validated against the current CRVAL/CD values, so a
+    header that was re-optimized in between transparently gets a freshly
+    built WCS object.
+
+    """
+
+    validation_keys = ('CRVAL1', 'CRVAL2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2')
+
+    def __init__(self):
+        self.cache = {}
+
+    def get(self, header):
+        key = id(header)
+        stamp = tuple(header[kw] if kw in header else None
+                      for kw in self.validation_keys)
+        if (key in self.cache):
+            cached_stamp, wcs = self.cache[key]
+            if (cached_stamp == stamp):
+                return wcs
+        wcs = astWCS.WCS(header, mode='pyfits')
+        self.cache[key] = (stamp, wcs)
+        return wcs
+
+
+def ota_membership(catalog):
+    """
 
+    Group catalog rows by their OTA number (column 8). Returns a dictionary
+    mapping each OTA to the row indices belonging to it, so loops over all
+    extensions can fancy-index their sub-catalog directly instead of
+    re-scanning the full OTA column once per extension.
 
+    """
+    ota_col = catalog[:,8].astype(numpy.int32)
+    return {int(ota): numpy.flatnonzero(ota_col == ota)
+            for ota in numpy.unique(ota_col)}
 
-def recompute_radec_from_xy(hdulist, src_catalog):
 
-    global_cat = None
+def recompute_radec_from_xy(hdulist, src_catalog, wcs_cache=None):
 
     #
-    # Now re-compute the OTA source catalog including the updated WCS solution
+    # Now re-compute the OTA source catalog including the updated WCS
+    # solution. The result can never hold more rows than the input, so
+    # fill a preallocated catalog slice by slice - appending per OTA
+    # re-allocates and copies the entire accumulated catalog every pass.
     #
+    global_cat = numpy.empty_like(src_catalog)
+    n_filled = 0
+    src_groups = ota_membership(src_catalog)
+    if (wcs_cache is None):
+        wcs_cache = WCSCache()
     for ext in range(len(hdulist)):
         if (not is_image_extension(hdulist[ext])):
             continue
 
         ota = hdulist[ext].header['OTA']
-        in_this_ota = src_catalog[:,8] == ota
+        if (ota not in src_groups):
+            continue
 
-        ota_full = src_catalog[in_this_ota]
-        astwcs = astWCS.WCS(hdulist[ext].header, mode='pyfits')
+        ota_full = src_catalog[src_groups[ota]]
+        astwcs = wcs_cache.get(hdulist[ext].header)
 
         ota_xy = ota_full[:,2:4] - [1.,1.]
         ota_radec = numpy.array(astwcs.pix2wcs(ota_xy[:,0], ota_xy[:,1]))
 
         ota_full[:,0:2] = ota_radec
 
-        global_cat = ota_full if (global_cat is None) else numpy.append(global_cat, ota_full, axis=0)
+        global_cat[n_filled:n_filled+ota_full.shape[0]] = ota_full
+        n_filled += ota_full.shape[0]
 
-    return global_cat
+    return global_cat[:n_filled]
 
 
 def improve_wcs_solution(src_catalog, 
@@ -1459,6 +1959,8 @@ def improve_wcs_solution(src_catalog,
                          min_ota_catalog_size=15,
                          output_catalog = None,
                          allow_parallel = True,
+                         wcs_cache = None,
+                         ref_tree = None,
                          ):
     """
 
@@ -1473,35 +1975,35 @@ def improve_wcs_solution(src_catalog,
 
     # Match the entire input catalog with the reference catalog
     # Allow a matching radius of 3'', but only unique matches
-    matched_global = kd_match_catalogs(src_catalog, 
-                                       ref_catalog, 
-                                       matching_radius=matching_radius, 
-                                       max_count=1)
-
-    global_cat = None
-
-    # Prepare what we need for the parallel execution
-    processes = []
-    queue_cmd = multiprocessing.JoinableQueue()
-    queue_cmd._start_thread()
-    queue_cmd._thread.name = "QFP_ImproveWCS_Jobs"
-
-    queue_return = multiprocessing.Queue()
-    queue_return._start_thread()
-    queue_return._thread.name = "WFP_ImproveWCS_Results"
-
-    number_tasks = 0
+    matched_global = kd_match_catalogs(src_catalog,
+                                       ref_catalog,
+                                       matching_radius=matching_radius,
+                                       max_count=1,
+                                       ref_tree=ref_tree)
+
+    # Collect one task per OTA for the parallel execution. In parallel mode,
+    # export the matched catalog into shared memory once so every worker can
+    # map it directly instead of receiving a pickled copy of its sub-catalog.
+    tasks = []
+    matched_shm = None
+    if (allow_parallel):
+        matched_shm, matched_descriptor = share_catalog(matched_global)
 
     logger.debug("Running improve_wcs_solution in %s mode!" % ("parallel" if allow_parallel else "serial"))
 
+    # Group the matched catalog by OTA once up front rather than scanning
+    # the full OTA column again for every extension
+    matched_groups = ota_membership(matched_global)
+    no_rows = numpy.empty((0,), dtype=numpy.int32)
+
     for ext in range(len(hdulist)):
         if (not is_image_extension(hdulist[ext])):
             continue
 
         ota = hdulist[ext].header['OTA']
-        in_this_ota = matched_global[:,8] == ota
+        ota_rows = matched_groups.get(ota, no_rows)
 
-        ota_cat = matched_global[in_this_ota]
+        ota_cat = matched_global[ota_rows]
         logger.debug("OTA %d: % 4d sources, have >= % 4d for this step : %s" % (
             ota, ota_cat.shape[0], min_ota_catalog_size, "yes" if ota_cat.shape[0] > min_ota_catalog_size else "no"))
 
@@ -1522,79 +2024,72 @@ def improve_wcs_solution(src_catalog,
                 #
                 # Do the work in parallel
                 #
-                task = (ota_cat, hdulist[ext].header, headers_to_optimize, ext)
-                queue_cmd.put(task)
-                number_tasks += 1
-
-
-    if (allow_parallel):
-        worker_args = {'queue_in': queue_cmd,
-                       'queue_out': queue_return,
-                       }
-        # All work is queued, start the processes to do the work
-        for i in range(sitesetup.number_cpus):
-            p = multiprocessing.Process(target=parallel_optimize_wcs_solution, kwargs=worker_args)
-            p.start()
-            processes.append(p)
-
-            # Also send a quit signal to each process
-            queue_cmd.put(None)
-
-        # Receive all results
-        for i_results in range(number_tasks):
-            catalog, header, extension_id = queue_return.get()
-
-            # Merge the catalogs
-            # global_cat = catalog if (global_cat == None) else numpy.append(global_cat, catalog, axis=0)
-
-            # And re-insert the updated header
+                tasks.append((matched_descriptor, ota_rows,
+                              hdulist[ext].header,
+                              headers_to_optimize, ext))
+
+    if (allow_parallel and len(tasks) > 0):
+        # Hand all tasks to the persistent worker pool and re-insert the
+        # optimized headers as the results come in
+        pool = get_wcs_optimization_pool()
+        for header, extension_id in \
+                pool.imap_unordered(parallel_optimize_wcs_solution, tasks):
+
+            # Re-insert the updated header
             hdulist[extension_id].header = header
 
-        # Wait until all work is complete
-        for p in processes:
-            p.join()
-
-  
-    queue_cmd.close()
-    queue_cmd.join_thread()
-    queue_return.close()
-    queue_return.join_thread()
+    if (matched_shm is not None):
+        matched_shm.close()
+        matched_shm.unlink()
 
     #
-    # Now re-compute the OTA source catalog including the updated WCS solution
+    # Now re-compute the OTA source catalog including the updated WCS
+    # solution. The output size is known up front, so fill a preallocated
+    # catalog slice by slice instead of re-allocating and copying the
+    # growing catalog with numpy.append for every OTA.
     #
+    global_cat = numpy.empty_like(src_catalog)
+    n_filled = 0
+    src_groups = ota_membership(src_catalog)
+    if (wcs_cache is None):
+        wcs_cache = WCSCache()
     for ext in range(len(hdulist)):
         if (not is_image_extension(hdulist[ext])):
             continue
 
         ota = hdulist[ext].header['OTA']
-        in_this_ota = src_catalog[:,8] == ota
-
-        if (numpy.sum(in_this_ota) <= 0):
+        if (ota not in src_groups):
             continue
 
-        ota_full = src_catalog[in_this_ota]
-        astwcs = astWCS.WCS(hdulist[ext].header, mode='pyfits')
+        ota_full = src_catalog[src_groups[ota]]
+        astwcs = wcs_cache.get(hdulist[ext].header)
 
         ota_xy = ota_full[:,2:4] - [1.,1.]
         ota_radec = numpy.array(astwcs.pix2wcs(ota_xy[:,0], ota_xy[:,1]))
 
         ota_full[:,0:2] = ota_radec
 
-        global_cat = ota_full if (type(global_cat) == type(None)) \
-                     else numpy.append(global_cat, ota_full, axis=0)
+        global_cat[n_filled:n_filled+ota_full.shape[0]] = ota_full
+        n_filled += ota_full.shape[0]
+
+    global_cat = global_cat[:n_filled]
 
-  
     # Match the new, improved catalog with the reference catalog
     # Allow a matching radius of 2'', but only unique matches
     logger.debug("Matching optimized source catalog to reference catalog")
-    matched_global = kd_match_catalogs(global_cat, 
-                                       ref_catalog, 
-                                       matching_radius=(2./3600.), 
-                                       max_count=1)
+    matched_global = kd_match_catalogs(global_cat,
+                                       ref_catalog,
+                                       matching_radius=(2./3600.),
+                                       max_count=1,
+                                       ref_tree=ref_tree)
 
     if (output_catalog is not None and create_debug_files):
-        numpy.savetxt(output_catalog, matched_global)
+        if (output_catalog.endswith(".npy")):
+            # binary dump - avoids savetxt's per-row ascii formatting,
+            # which takes seconds for the larger matched catalogs
+            numpy.save(output_catalog, matched_global)
+        else:
+            numpy.savetxt(output_catalog, matched_global)
 
     # print "Returning from improve_wcs_solution", src_catalog.shape, global_cat.shape, matched_global.shape
 
@@ -1664,6 +2159,202 @@ def estimate_match_fraction(src_cat, primary_header, meanTeff = 5000):
     
 
 
+def distortion_fit_basis(xy, wcs_poly, n_free_parameters):
+    """
+
+    Precompute everything in the distortion residual that does not depend
+    on the fit parameters: the polynomial basis columns belonging to each
+    free coefficient (the distortion polynomials are linear in their
+    coefficients), and the fixed xi'/eta' contribution of all coefficients
+    that are not being fit. With these in hand, xi' and eta' at any
+    parameter vector are a single matrix-vector product plus the offset.
+
+    """
+    c_xi, c_xi_r, c_eta, c_eta_r, cd, crval, crpix = wcs_poly
+
+    rel = xy - crpix
+    xi = rel[:,0] * cd[0,0] + rel[:,1] * cd[0,1]
+    # (sic) wcs_pix2wcs uses the y-offset for both CD2_x terms
+    eta = rel[:,1] * cd[1,0] + rel[:,1] * cd[1,1]
+    r = numpy.hypot(xi, eta)
+
+    basis_xi = numpy.zeros(shape=(xy.shape[0], n_free_parameters))
+    basis_eta = numpy.zeros_like(basis_xi)
+    for (i,j) in itertools.product(range(ordering.shape[0]),
+                                   range(ordering.shape[1])):
+        m = ordering[i,j]
+        if (m >= 0 and m < n_free_parameters):
+            basis_xi[:,m] = xi**j * eta**i
+            basis_eta[:,m] = eta**j * xi**i
+    for k in range(ordering_r.shape[1]):
+        m = ordering_r[0,k]
+        if (m >= 0 and m < n_free_parameters):
+            basis_xi[:,m] = r**k
+            basis_eta[:,m] = r**k
+
+    # The non-free coefficients never change during the fit, so their
+    # contribution to xi'/eta' is a constant offset
+    c_xi_fixed = c_xi.copy()
+    c_eta_fixed = c_eta.copy()
+    free_2d = (ordering >= 0) & (ordering < n_free_parameters)
+    c_xi_fixed[free_2d] = 0.
+    c_eta_fixed[free_2d] = 0.
+    c_xi_r_fixed = c_xi_r.copy()
+    c_eta_r_fixed = c_eta_r.copy()
+    free_r = (ordering_r >= 0) & (ordering_r < n_free_parameters)
+    c_xi_r_fixed[free_r] = 0.
+    c_eta_r_fixed[free_r] = 0.
+
+    offset_xi = polyval2d(xi, eta, c_xi_fixed) \
+        + numpy.polynomial.polynomial.polyval(r, c_xi_r_fixed[0])
+    offset_eta = polyval2d(eta, xi, c_eta_fixed) \
+        + numpy.polynomial.polynomial.polyval(r, c_eta_r_fixed[0])
+
+    return basis_xi, basis_eta, offset_xi, offset_eta
+
+
+def distortion_fit_jacobian(p, basis_xi, basis_eta,
+                            offset_xi, offset_eta, crval):
+    """
+
+    Analytic Jacobian of the distortion residual: the chain rule through
+    the tangent-plane de-projection of wcs_pix2wcs, applied to the
+    polynomial basis from `distortion_fit_basis`. Layout matches
+    least_squares expectations, (2N, 2*n_params) with Ra rows at 0::2.
+
+    """
+    n_params = p.shape[0] // 2
+
+    xi_prime = basis_xi.dot(p[:n_params]) + offset_xi
+    eta_prime = basis_eta.dot(p[n_params:]) + offset_eta
+
+    deg2rad = math.pi / 180.
+    cos_dec0 = math.cos(crval[1] * deg2rad)
+    tan_dec0 = math.tan(crval[1] * deg2rad)
+
+    u = xi_prime * deg2rad
+    v = eta_prime * deg2rad
+    a1 = u / cos_dec0
+    a2 = 1. - v * tan_dec0
+    norm_a = a1*a1 + a2*a2
+    alpha = numpy.arctan2(a1, a2)
+    # Ra = alpha/deg2rad + crval[0] with u = xi'*deg2rad, so the scale
+    # factors cancel and dRa/dxi' is just dalpha/du (same for dec below)
+    dra_dxi = (a2 / cos_dec0) / norm_a
+    dra_deta = (a1 * tan_dec0) / norm_a
+
+    sin_alpha = numpy.sin(alpha)
+    cos_alpha = numpy.cos(alpha)
+    d1 = (v + tan_dec0) * cos_alpha
+    norm_d = a2*a2 + d1*d1
+    ddec_dxi = -a2 * (v + tan_dec0) * sin_alpha * dra_dxi / norm_d
+    ddec_deta = (a2 * (cos_alpha - (v + tan_dec0) * sin_alpha * dra_deta)
+                 + d1 * tan_dec0) / norm_d
+
+    # residual is ref - radec, hence the sign flip
+    jac = numpy.empty(shape=(2*basis_xi.shape[0], 2*n_params))
+    jac[0::2, :n_params] = -dra_dxi[:,None] * basis_xi
+    jac[0::2, n_params:] = -dra_deta[:,None] * basis_eta
+    jac[1::2, :n_params] = -ddec_dxi[:,None] * basis_xi
+    jac[1::2, n_params:] = -ddec_deta[:,None] * basis_eta
+    return jac
+
+
+def distortion_fit_residual(p, basis_xi, basis_eta,
+                            offset_xi, offset_eta, crval, ref_radec):
+    """
+
+    Distortion residual specialized for the Gauss-Newton loop: with the
+    basis from `distortion_fit_basis` in hand, xi' and eta' are a single
+    matrix-vector product each, so only the tangent-plane de-projection
+    remains per evaluation - no coefficient-table update and no full
+    re-evaluation of the 6x6 polynomials as in the generic residual.
+    Layout matches the Jacobian, Ra rows at 0::2.
+
+    """
+    n_params = p.shape[0] // 2
+
+    xi_prime = basis_xi.dot(p[:n_params]) + offset_xi
+    eta_prime = basis_eta.dot(p[n_params:]) + offset_eta
+
+    deg2rad = math.pi / 180.
+    cos_dec0 = math.cos(crval[1] * deg2rad)
+    tan_dec0 = math.tan(crval[1] * deg2rad)
+
+    u = xi_prime * deg2rad
+    v = eta_prime * deg2rad
+    a1 = u / cos_dec0
+    a2 = 1. - v * tan_dec0
+    alpha = numpy.arctan2(a1, a2)
+    ra = alpha / deg2rad + crval[0]
+    d1 = (v + tan_dec0) * numpy.cos(alpha)
+    dec = numpy.arctan2(d1, a2) / deg2rad
+
+    resid = numpy.empty(shape=(2*basis_xi.shape[0],))
+    resid[0::2] = ref_radec[:,0] - ra
+    resid[1::2] = ref_radec[:,1] - dec
+    return resid
+
+
+if (numba is not None):
+    @numba.njit(cache=True, fastmath=True)
+    def _distortion_pix2wcs(xy, c_xi, c_xi_r, c_eta, c_eta_r,
+                            cd, crval, crpix, out):
+        """
+
+        Compiled version of podi_wcs.wcs_pix2wcs for the distortion fit:
+        CD-matrix projection, 2-d + radial distortion polynomials and the
+        final de-projection onto the sky, written as explicit loops over
+        all sources. Replaces one polyval2d call (36 full-array passes)
+        plus several numpy temporaries per residual evaluation.
+
+        """
+        deg2rad = math.pi / 180.
+        cos_dec0 = math.cos(crval[1] * deg2rad)
+        tan_dec0 = math.tan(crval[1] * deg2rad)
+        for n in range(xy.shape[0]):
+            rel_x = xy[n,0] - crpix[0]
+            rel_y = xy[n,1] - crpix[1]
+            xi = rel_x * cd[0,0] + rel_y * cd[0,1]
+            # (sic) wcs_pix2wcs uses the y-offset for both CD2_x terms
+            eta = rel_y * cd[1,0] + rel_y * cd[1,1]
+            r = math.hypot(xi, eta)
+
+            # 2-d distortion polynomials: xi' sums c_xi[i,j]*xi**j*eta**i,
+            # eta' the same with the roles of xi and eta swapped
+            xi_prime = 0.
+            eta_prime = 0.
+            eta_pow = 1.
+            xi_pow_o = 1.
+            for i in range(c_xi.shape[0]):
+                xi_pow = 1.
+                eta_pow_o = 1.
+                for j in range(c_xi.shape[1]):
+                    xi_prime += c_xi[i,j] * xi_pow * eta_pow
+                    eta_prime += c_eta[i,j] * eta_pow_o * xi_pow_o
+                    xi_pow *= xi
+                    eta_pow_o *= eta
+                eta_pow *= eta
+                xi_pow_o *= xi
+
+            # radial distortion terms
+            r_pow = 1.
+            for k in range(c_xi_r.shape[1]):
+                xi_prime += c_xi_r[0,k] * r_pow
+                eta_prime += c_eta_r[0,k] * r_pow
+                r_pow *= r
+
+            # de-project onto the sky
+            xip = xi_prime * deg2rad
+            etap = eta_prime * deg2rad
+            a2 = 1. - etap * tan_dec0
+            alpha = math.atan2(xip / cos_dec0, a2)
+            out[n,0] = alpha / deg2rad + crval[0]
+            d1 = (etap + tan_dec0) * math.cos(alpha)
+            out[n,1] = math.atan2(d1, a2) / deg2rad
+        return out
+
+
 #############################################################################
 #############################################################################
 #
@@ -1809,6 +2500,17 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     hdulist[0].header['WCS_MODE'] = ('none',
                                      "method to calibrate WCS")
 
+    #
+    # Identify all image extensions and their OTA numbers once - the loops
+    # further down only care about image extensions, so there is no need
+    # to re-check every HDU (and re-parse its FPPOS keyword) per loop
+    #
+    image_extensions = [i for i in range(len(hdulist))
+                        if is_image_extension(hdulist[i])]
+    ota_by_ext = {}
+    for i in image_extensions:
+        if ('FPPOS' in hdulist[i].header):
+            ota_by_ext[i] = int(hdulist[i].header['FPPOS'][2:4])
 
     #
     # compute the center of the field
@@ -1882,26 +2584,23 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     
 
     #
-    # eliminate all stars with problematic flags
+    # Eliminate all stars with problematic flags, as well as all stars
+    # that are just barely detected (mag err > 0.3mag, equiv to S/N ~ 3)
+    # and/or too compact (FWHM < 0.3'') to be "real" stars. Fusing all
+    # criteria into one mask means the catalog is filtered and copied
+    # only once instead of once per criterion.
     #
-    flags = numpy.array(src_raw[:,SXcolumn['flags']], dtype=numpy.int8)
-    full_src_cat = src_raw[flags == 0]
+    likely_real_stars = (src_raw[:,SXcolumn['flags']] == 0) & \
+                        (src_raw[:,SXcolumn['fwhm_world']] > 0.3/3600.) & \
+                        (src_raw[:,SXcolumn['mag_err_4.0']] < 0.3)
+    full_src_cat = src_raw[likely_real_stars]
     logger.debug("src_cat: "+str(full_src_cat.shape))
     if (create_debug_files): numpy.savetxt("ccmatch.src_cat", full_src_cat[:,0:2])
 
     if (create_debug_files):
         numpy.savetxt("ccdebug.ref", ref_raw)
         numpy.savetxt("ccdebug.src", full_src_cat[:,0:2])
-
-
-    #
-    # Eliminate all stars that are just barely detected (mag err > 0.3mag, 
-    # equiv to S/N ~ 3) and/or too compact (FWHM < 0.3'') to be "real" stars
-    #
-    likely_real_stars = (full_src_cat[:,SXcolumn['fwhm_world']] > 0.3/3600.) & \
-                        (full_src_cat[:,SXcolumn['mag_err_4.0']] < 0.3)
-    full_src_cat = full_src_cat[likely_real_stars]
-    if (create_debug_files): numpy.savetxt("ccmatch.src_cat2", full_src_cat[:,0:2])
+        numpy.savetxt("ccmatch.src_cat2", full_src_cat[:,0:2])
     logger.debug("Down-selecting source catalog to %d well-detected and not too-compact sources" % (
         full_src_cat.shape[0]))
 
@@ -2006,17 +2705,49 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
         if (ref_close.shape[0] > n_max_ref):
             logger.debug("Lots of stars (%d) in the reference catalog" % (ref_close.shape[0]))
 
-        ref_cat = ref_close.copy()
+        # No copy needed here - pick_isolated_stars only reads the catalog
+        # and returns a fancy-indexed (and thus freshly allocated) subset
+        ref_cat = ref_close
         min_distance = 8
         logger.debug("Selecting isolated stars - reference catalog")
         if (create_debug_files): numpy.savetxt("ccmatch.2mass_full.%d" % (pointing_error), ref_cat)
-        while ((ref_cat.shape[0] > n_max_ref or min_distance < 10) and use_only_isolated_reference_stars):
-            min_distance += 2
-            ref_cat = pick_isolated_stars(ref_cat, radius=min_distance)
-            if (create_debug_files): 
+        # Only the isolation radius changes from one pass to the next, so
+        # build the kD-tree once and re-query it with growing radii
+        # instead of rebuilding it from the shrinking catalog every pass
+        iso_cat = ref_cat
+        iso_tree = scipy.spatial.cKDTree(iso_cat[:,0:2], **kdtree_opts)
+        if (use_only_isolated_reference_stars):
+            # The number of isolated stars shrinks monotonically with the
+            # isolation radius, so instead of growing the radius in 2''
+            # steps and re-filtering every time, binary-search for the
+            # smallest radius (even arcsec, at least 10'') that brings
+            # the catalog down to n_max_ref stars or less
+            def count_isolated(radius):
+                neighbor_count = iso_tree.query_ball_point(
+                    iso_cat[:,0:2], radius/3600., p=2,
+                    return_length=True, workers=-1)
+                n_isolated = numpy.sum(neighbor_count <= 1)
+                logger.debug("Probing isolation radius %d'': %d isolated stars" % (
+                    radius, n_isolated))
+                return n_isolated
+
+            # radii in units of the 2'' step size; extend the upper bound
+            # in the (unlikely) case that even 60'' leaves too many stars
+            lo, hi = 5, 30
+            while (count_isolated(2*hi) > n_max_ref):
+                lo, hi = hi+1, 2*hi
+            while (lo < hi):
+                mid = (lo + hi) // 2
+                if (count_isolated(2*mid) <= n_max_ref):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            min_distance = 2*lo
+
+            ref_cat = pick_isolated_stars(iso_cat, radius=min_distance,
+                                          kdtree=iso_tree)
+            if (create_debug_files):
                 numpy.savetxt("ccmatch.2mass_isolated.%d.%d" % (pointing_error, min_distance), ref_cat)
-            logger.debug("Down-selected reference catalog to %d isolated stars (min_d=%d'')" % (
-                ref_cat.shape[0], min_distance))
         logger.debug("Final reference catalog: %d sources, isolated by >%d arcsec" % (
             ref_cat.shape[0], min_distance))
 
@@ -2113,22 +2844,32 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     current_best_shift = initial_guess[1:3]
     logger.debug("Improving global shift/rotation solution")
     logger.debug("Full ODI source catalog: %d" % (full_src_cat.shape[0]))
-    guessed_cat = rotate_shift_catalog(full_src_cat, (center_ra, center_dec), 
-                                       angle=current_best_rotation,
-                                       shift=current_best_shift,
-                                       verbose=False)
-    if (create_debug_files): numpy.savetxt("ccmatch.guessed_cat", guessed_cat)
-
-    # 
-    # With this best guess at hand, match each star in the source 
-    # catalog to a closest match in the reference catalog.
-    # Use the full catalog of all close 2MASS stars to have a larger sample
-    # 
     logger.debug("2MASS reference stars nearby: %d" % (ref_close.shape[0]))
     crossmatch_radius = 5./3600. # 5 arcsec
-    guessed_match = kd_match_catalogs(guessed_cat, ref_close, crossmatch_radius, max_count=1)
-    logger.debug("Matched ODI+2MASS: %d" % (guessed_match.shape[0]))
-    if (create_debug_files): numpy.savetxt("ccmatch.guessed_match", guessed_match)
+    # ref_close gets matched against several times below, so apply the
+    # cos(declination) scaling and build the kD-tree only once up front
+    ref_close_scaled = scale_catalog(ref_close)
+    ref_close_tree = scipy.spatial.cKDTree(ref_close_scaled.data[:,0:2],
+                                           **kdtree_opts)
+
+    #
+    # Apply the best guess to the full catalog and match each star to its
+    # closest reference counterpart. This transformed/matched catalog is
+    # only the end result of the shift-only mode, so skip both steps when
+    # a later stage supersedes them anyway
+    #
+    if (mode == "shift" or create_debug_files):
+        guessed_cat = rotate_shift_catalog(full_src_cat, (center_ra, center_dec),
+                                           angle=current_best_rotation,
+                                           shift=current_best_shift,
+                                           verbose=False)
+        if (create_debug_files): numpy.savetxt("ccmatch.guessed_cat", guessed_cat)
+
+        guessed_match = kd_match_catalogs(guessed_cat, ref_close_scaled,
+                                          crossmatch_radius, max_count=1,
+                                          ref_tree=ref_close_tree)
+        logger.debug("Matched ODI+2MASS: %d" % (guessed_match.shape[0]))
+        if (create_debug_files): numpy.savetxt("ccmatch.guessed_match", guessed_match)
 
 
     if (mode == "shift"):
@@ -2176,16 +2917,20 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     logger.debug("Refined guess: dra/ddec = %.7f / %.7f deg [ %.2f / %.2f arcsec]" % (
         best_shift_rotation_solution[1], best_shift_rotation_solution[2], best_shift_rotation_solution[1]*3600., best_shift_rotation_solution[2]*3600.))
 
-    src_rotated = rotate_shift_catalog(full_src_cat, (center_ra, center_dec), 
-                                       angle=best_shift_rotation_solution[0],
-                                       shift=best_shift_rotation_solution[1:3],
-                                       verbose=False)
-    matched = kd_match_catalogs(src_rotated, ref_close, matching_radius=(2./3600.), max_count=1)
-    if (create_debug_files): numpy.savetxt("ccmatch.after_shift+rot", matched)
+    if (create_debug_files):
+        # transformation + match of the full catalog with the refined
+        # solution - only consumed by the debug dump
+        src_rotated = rotate_shift_catalog(full_src_cat, (center_ra, center_dec),
+                                           angle=best_shift_rotation_solution[0],
+                                           shift=best_shift_rotation_solution[1:3],
+                                           verbose=False)
+        matched = kd_match_catalogs(src_rotated, ref_close_scaled,
+                                    matching_radius=(2./3600.), max_count=1,
+                                    ref_tree=ref_close_tree)
+        numpy.savetxt("ccmatch.after_shift+rot", matched)
 
     current_best_rotation = best_shift_rotation_solution[0]
     current_best_shift = best_shift_rotation_solution[1:3]
-    n_matches = numpy.sum(numpy.isfinite(matched[:,2]))
 
     # Add the refined shift and rotation to output header to keep track 
     # of the changes we are making
@@ -2202,12 +2947,17 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
 
     # For testing, apply correction to the input catalog, 
     # match it to the reference catalog and output both to file
-    src_rotated = rotate_shift_catalog(src_raw, (center_ra, center_dec), 
+    src_rotated = rotate_shift_catalog(src_raw, (center_ra, center_dec),
                                        angle=current_best_rotation,
                                        shift=current_best_shift,
                                        verbose=False)
-    matched = kd_match_catalogs(src_rotated, ref_close, matching_radius=(2./3600.), max_count=1)
-    if (create_debug_files): 
+    # the matched catalog is only the end result of the rotation-only
+    # mode - the OTA-level stages below re-match after every optimization
+    if (mode == "rotation" or create_debug_files):
+        matched = kd_match_catalogs(src_rotated, ref_close_scaled,
+                                    matching_radius=(2./3600.), max_count=1,
+                                    ref_tree=ref_close_tree)
+    if (create_debug_files):
         print("XXX:", center_ra, center_dec, current_best_rotation, current_best_shift)
         numpy.savetxt("ccmatch.1.raw", src_raw)
         numpy.savetxt("ccmatch.1.rotated", src_rotated)
@@ -2246,16 +2996,21 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     #
     logger.debug("Optimizing each OTA separately, shift only (ODI: %d, 2MASS: %d)" % (
         src_rotated.shape[0], ref_close.shape[0]))
+    # Share one WCS cache across both optimization stages; entries are
+    # invalidated automatically when the optimization changes CRVAL/CD
+    wcs_cache = WCSCache()
     global_cat, hdulist, matched_global = \
-        improve_wcs_solution(src_rotated, 
-                             ref_close,
+        improve_wcs_solution(src_rotated,
+                             ref_close_scaled,
                              hdulist,
                              headers_to_optimize=(
                                  'CRVAL1', 'CRVAL2',
                              ),
                              matching_radius=(3./3600),
                              min_ota_catalog_size=4,
-                             output_catalog = "ccmatch.after_otashift",
+                             output_catalog = "ccmatch.after_otashift.npy",
+                             wcs_cache=wcs_cache,
+                             ref_tree=ref_close_tree,
                          )
 
 
@@ -2278,8 +3033,8 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     logger.debug("Optimizing each OTA separately, shift+shear (ODI: %d, 2MASS: %d)" % (
         global_cat.shape[0], ref_close.shape[0]))
     global_cat, hdulist, matched_global = \
-        improve_wcs_solution(global_cat, 
-                             ref_close,
+        improve_wcs_solution(global_cat,
+                             ref_close_scaled,
                              hdulist,
                              headers_to_optimize=(
                                  'CRVAL1', 'CRVAL2',
@@ -2287,7 +3042,9 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
                              ),
                              matching_radius=(3./3600),
                              min_ota_catalog_size=9,
-                             output_catalog = "ccmatch.after_shear2",
+                             output_catalog = "ccmatch.after_shear2.npy",
+                             wcs_cache=wcs_cache,
+                             ref_tree=ref_close_tree,
                          )
 
     if (mode == "otashear"):
@@ -2323,20 +3080,21 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     full_src_cat = src_raw.copy()
     if (create_debug_files): numpy.savetxt("ccmatch.opt_src", full_src_cat)
     
-    src_rotated = rotate_shift_catalog(full_src_cat[:,0:2], (center_ra, center_dec), 
-                                       angle=current_best_rotation,
-                                       shift=current_best_shift,
-                                       verbose=True)
+    # src_raw was already rotated/shifted with exactly these parameters
+    # right after the shift+rotation fit above, so reuse that result
+    # instead of transforming the full catalog a second time
 
-    if (create_debug_files): numpy.savetxt("ccmatch.opt_rot", src_rotated)
+    if (create_debug_files): numpy.savetxt("ccmatch.opt_rot", src_rotated[:,0:2])
 
     # Update the Ra/Dec in the full source catalog
     full_src_cat[:,0:2] = src_rotated[:,0:2]
 
     # Now we have the full source catalog, with better matching star coordinates
     # Next, eliminate all stars with flags
-    valid_stars = full_src_cat[:,7] == 0
-    valid_src_cat = full_src_cat[valid_stars]
+    # indexing by the flagged-row positions rather than a boolean mask
+    # makes the index list reusable downstream without re-scanning flags
+    valid_idx = numpy.flatnonzero(full_src_cat[:,7] == 0)
+    valid_src_cat = full_src_cat[valid_idx]
 
     if (create_debug_files): numpy.savetxt("ccmatch.opt_ref", ref_cat)
     if (create_debug_files): numpy.savetxt("ccmatch.opt_valid", valid_src_cat)
@@ -2356,19 +3114,36 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
     
     print("OTAs of each source:\n",matched_catalog[:,8])
 
-    for ext in range(len(hdulist)):
-        if (not is_image_extension(hdulist[ext])):
-            continue
-
+    # Sort the matched catalog by OTA once; every OTA is then a contiguous
+    # slice located with two binary searches instead of a full boolean scan
+    # (and fancy-indexing copy) of the whole catalog per OTA
+    ota_order = numpy.argsort(matched_catalog[:,8], kind='stable')
+    matched_sorted = matched_catalog[ota_order]
+    ota_column = matched_sorted[:,8]
+
+    # The fit only ever touches the x/y and reference Ra/Dec columns, so
+    # pull those out into contiguous arrays once - per-OTA slices of them
+    # are then unit-stride instead of hopping across all 30+ columns of
+    # the matched catalog for every element
+    xy_all = numpy.ascontiguousarray(matched_sorted[:,2:4])
+    ref_all = numpy.ascontiguousarray(matched_sorted[:,-2:])
+
+    # The per-OTA fits are completely independent of each other, so first
+    # collect the fitting inputs for every OTA, then run all fits on the
+    # persistent worker pool, and finally write the fitted polynomials back
+    # into the FITS headers serially once all results are in
+    distortion_tasks = []
+    fitted_wcs_polys = {}
+    for ext in image_extensions:
         ota_extension = hdulist[ext]
-        # print ota_extension.header['FPPOS'], ota_extension.header['FPPOS'][2:4]
-        ota = int(ota_extension.header['FPPOS'][2:4])
+        ota = ota_by_ext[ext]
         print("\n\n\nworking on OTA %02d ..." %(ota))
 
         # sources from this OTA
-        in_this_ota = (matched_catalog[:,8] == ota)
-        print(numpy.sum(in_this_ota))
-        number_src_in_this_ota = numpy.sum(in_this_ota)
+        ota_start = numpy.searchsorted(ota_column, ota, 'left')
+        ota_end = numpy.searchsorted(ota_column, ota, 'right')
+        number_src_in_this_ota = ota_end - ota_start
+        print(number_src_in_this_ota)
 
         # Read the WCS imformation from the fits file
         wcs_poly = header_to_polynomial(ota_extension.header)
@@ -2380,110 +3155,32 @@ def ccmatch(source_catalog, reference_catalog, input_hdu, mode,
 
         if (number_src_in_this_ota < 15):
             print("Not enough stars to optimize distortion")
-            wcs_poly_after_fit = wcs_poly
+            fitted_wcs_polys[ext] = wcs_poly
 
         else:
 
             # print in_this_ota
             # print matched_catalog[:,8]
 
-            ota_cat = matched_catalog[in_this_ota]
-            ota_ref = matched_catalog[in_this_ota][:,-2:] #31:33]
-
-            print("sources in ota %d = %s ..." % (ota, str(ota_cat.shape)))
-
-            xi, xi_r, eta, eta_r, cd, crval, crpix = wcs_poly
-            #numpy.savetxt(sys.stdout, xi, "%9.2e")
-            #numpy.savetxt(sys.stdout, xi_r, "%9.2e")
-
-            # wcs_poly = update_polynomial(wcs_poly, 
-            #                              numpy.array([1.11, 2.22, 3.33, 4.44]), 
-            #                              numpy.array([1.11, 2.22, 3.33, 4.44]), 
-            #                              )
-
-            # Read starting values from current WCS solution
-            wcs_poly_to_arrays(wcs_poly)
-
-            #
-            # Now with the updated header, compute ra,dec from x,y
-            #
-            ra_dec = wcs_pix2wcs(ota_cat[:,2:4], wcs_poly)
-
-            if (create_debug_files): numpy.savetxt("ccmatch.true_radec.OTA%02d" % (ota), ota_cat[:,0:2])
-            if (create_debug_files): numpy.savetxt("ccmatch.computed_radec.OTA%02d" % (ota), ra_dec)
-
-            xi, xi_r, eta, eta_r, cd, crval, crpix = wcs_poly
-            xi[0,0] = 10000
-            wcs_poly2 = xi, xi_r, eta, eta_r, cd, crval, crpix
-            ra_dec2 = wcs_pix2wcs_2(ota_cat[:,2:4], wcs_poly2)
-            if (create_debug_files): numpy.savetxt("ccmatch.computed_radec2.OTA%02d" % (ota), ra_dec2)
-
-            # sys.exit(0)
-
-            xi, xi_r, eta, eta_r, cd, crval, crpix = wcs_poly
-            print()
-            #numpy.savetxt(sys.stdout, xi, "%9.2e")
-            #numpy.savetxt(sys.stdout, xi_r, "%9.2e")
-
-            def optimize_distortion(p, input_xy, input_ref, wcs_poly, fit=True):
-                n_params = p.shape[0] / 2
-                p_xi = p[:n_params]
-                p_eta = p[-n_params:]
-
-                wcs_poly_for_fit = update_polynomial(wcs_poly, p_xi, p_eta)
-
-                ra_dec_computed = wcs_pix2wcs(input_xy, wcs_poly_for_fit)
-                diff = input_ref - ra_dec_computed
-                if (not fit):
-                    return diff
-                print(p_xi,p_eta,numpy.sum(diff**2))
-                return diff.ravel()
-
-            #
-            # Determine initial guesses from the current wcs distortion
-            #
-            xi_1d, eta_1d = wcs_poly_to_arrays(wcs_poly)
-
-            # For now, let's optimize only the first 4 factors
-            n_free_parameters = 3 # or 4 or 7 or 12 or 17 or 24
-            p_init = numpy.append(xi_1d[:n_free_parameters], eta_1d[:n_free_parameters])
-            print(p_init)
-
-            print("ota-cat=\n",ota_cat[:,2:4])
-            print("ota-ref=\n",ota_ref)
-
-            diff = optimize_distortion(p_init, ota_cat[:,2:4], ota_ref, wcs_poly, fit=False)
-            if (create_debug_files): numpy.savetxt("ccmatch.optimize_distortion_before_OTA%02d" % (ota), diff)
-
-            if (True):
-                print("\n\n\n\n\n\n\nStarting fitting\n\n\n\n\n")
-                args = (ota_cat[:,2:4], ota_ref, wcs_poly, True)
-                fit = scipy.optimize.leastsq(optimize_distortion, 
-                                             p_init, 
-                                             args=args, 
-                                             full_output=1)
-
-                print("\n\n\n\n\n\n\nDone with fitting")
-                print(p_init)
-                print(fit[0])
-                print("\n\n\n\n\n")
-                p_afterfit = fit[0]
-            else:
-                p_afterfit = p_init
+            distortion_tasks.append((ota, wcs_poly,
+                                     xy_all[ota_start:ota_end],
+                                     ref_all[ota_start:ota_end], #31:33]
+                                     matched_sorted[ota_start:ota_end,0:2],
+                                     ext))
 
-            diff_after = optimize_distortion(p_afterfit, ota_cat[:,2:4], ota_ref, wcs_poly, fit=False)
-            if (create_debug_files): numpy.savetxt("ccmatch.optimize_distortion_after_OTA%02d" % (ota), diff_after)
-        
-            wcs_poly_after_fit = update_polynomial(wcs_poly, 
-                                                   p_afterfit[:n_free_parameters],
-                                                   p_afterfit[-n_free_parameters:]
-                                                   )
+    if (len(distortion_tasks) > 0):
+        pool = get_wcs_optimization_pool()
+        for wcs_poly_after_fit, extension_id in \
+                pool.imap_unordered(parallel_fit_ota_distortion,
+                                    distortion_tasks):
+            fitted_wcs_polys[extension_id] = wcs_poly_after_fit
 
-        #
-        # Make sure to write the updated WCS header back to the HDU
-        # This is done even if not enough sources for distortion fitting were found
-        #
-        wcs_wcspoly_to_header(wcs_poly_after_fit, ota_extension.header)
+    #
+    # Make sure to write the updated WCS header back to the HDU
+    # This is done even if not enough sources for distortion fitting were found
+    #
+    for ext in image_extensions:
+        wcs_wcspoly_to_header(fitted_wcs_polys[ext], hdulist[ext].header)
 
     #print "writing results ..."
     #hduout = pyfits.HDUList(hdulist[0:3])
@@ -2526,49 +3223,59 @@ def compute_wcs_quality(odi_2mass_matched, hdr=None):
     logger = logging.getLogger("ComputeWCSQuality")
 
     d_dec = (odi_2mass_matched[:,1] - odi_2mass_matched[:,-1])
-    d_ra  = ((odi_2mass_matched[:,0] - odi_2mass_matched[:,-2]) 
-             * numpy.cos(numpy.radians(odi_2mass_matched[:,1])))
+    if (numexpr is not None):
+        # fuse subtraction, deg->rad conversion, cosine and product into
+        # one pass over the catalog instead of a temp array per operator
+        src_ra = odi_2mass_matched[:,0]
+        ref_ra = odi_2mass_matched[:,-2]
+        src_dec = odi_2mass_matched[:,1]
+        d_ra = numexpr.evaluate(
+            "(src_ra - ref_ra) * cos(src_dec * %.20g)" % (math.pi/180.))
+        d_total = numexpr.evaluate("sqrt(d_ra**2 + d_dec**2)")
+    else:
+        d_ra = (odi_2mass_matched[:,0] - odi_2mass_matched[:,-2])
+        # in-place product avoids one more full-size temporary
+        d_ra *= numpy.cos(numpy.radians(odi_2mass_matched[:,1]))
+        d_total = numpy.hypot(d_ra, d_dec)
 
     if (create_debug_files): numpy.savetxt("wcsquality.test", odi_2mass_matched)
-    d_total = numpy.hypot(d_ra, d_dec)
     wcs_scatter = numpy.median(d_total)
     wcs_scatter2 = numpy.std(d_total)
     wcs_mean_dra = numpy.median(d_ra) * 3600.
     wcs_mean_ddec = numpy.median(d_dec) * 3600.
-    rms_dra = numpy.sqrt(numpy.mean(d_ra**2)) * 3600.
-    rms_ddec = numpy.sqrt(numpy.mean(d_dec**2)) * 3600.
-    rms_comb = numpy.sqrt(numpy.mean(d_dec**2+d_ra**2)) * 3600.
-
-    d_combined = numpy.hypot(d_dec, d_ra)
-    valid = numpy.isfinite(d_combined)
+    # compute the squared residuals once and reuse them for all rms values
+    sq_ra = d_ra * d_ra
+    sq_dec = d_dec * d_dec
+    rms_dra = numpy.sqrt(numpy.mean(sq_ra)) * 3600.
+    rms_ddec = numpy.sqrt(numpy.mean(sq_dec)) * 3600.
+    rms_comb = numpy.sqrt(numpy.mean(sq_ra+sq_dec)) * 3600.
+
+    valid = numpy.isfinite(d_total)
     if (numpy.sum(valid) <= 1):
         clip_rms_dra, clip_rms_ddec, clip_rms_comb = -1, -1, -1
         logger.error("Unable to compute some WCS quality parameters")
     else:
         for iteration in range(3):
-            d_stats = numpy.percentile(d_combined[valid], [16,50,84])
+            d_stats = numpy.percentile(d_total[valid], [16,50,84])
             d_median = d_stats[1]
             d_sigma = 0.5*(d_stats[2] - d_stats[0])
-            bad = (d_combined > d_median + 3*d_sigma) | (d_combined < d_median - 3*d_sigma)
+            bad = (d_total > d_median + 3*d_sigma) | (d_total < d_median - 3*d_sigma)
             valid[bad] = False
-        clip_rms_dra = numpy.sqrt(numpy.mean(d_ra[valid]**2)) * 3600.
-        clip_rms_ddec = numpy.sqrt(numpy.mean(d_dec[valid]**2)) * 3600.
-        clip_rms_comb = numpy.sqrt(numpy.mean(d_dec[valid]**2+d_ra[valid]**2)) * 3600.
-
-
-    try:
-        lsig_ra = scipy.stats.scoreatpercentile(d_ra, 16)
-        hsig_ra = scipy.stats.scoreatpercentile(d_ra, 84)
-        sigma_ra = 0.5 * (hsig_ra - lsig_ra) * 3600.
-        lsig_dec = scipy.stats.scoreatpercentile(d_dec, 16)
-        hsig_dec = scipy.stats.scoreatpercentile(d_dec, 84)
-        sigma_dec = 0.5 * (hsig_dec - lsig_dec) * 3600.
-        lsig_total = scipy.stats.scoreatpercentile(d_total, 16)
-        hsig_total = scipy.stats.scoreatpercentile(d_total, 84)
-        sigma_total = 0.5 * (hsig_total - lsig_total) * 3600.
-    except:
+        clip_rms_dra = numpy.sqrt(numpy.mean(sq_ra[valid])) * 3600.
+        clip_rms_ddec = numpy.sqrt(numpy.mean(sq_dec[valid])) * 3600.
+        clip_rms_comb = numpy.sqrt(numpy.mean(sq_ra[valid]+sq_dec[valid])) * 3600.
+
+    # one sort over a (N,3) stack instead of six separate
+    # scoreatpercentile calls that each re-sort their input
+    finite = numpy.isfinite(d_ra) & numpy.isfinite(d_dec) & \
+             numpy.isfinite(d_total)
+    if (numpy.sum(finite) > 0):
+        lo, hi = numpy.percentile(
+            numpy.column_stack([d_ra, d_dec, d_total])[finite],
+            [16, 84], axis=0)
+        sigma_ra, sigma_dec, sigma_total = 0.5 * (hi - lo) * 3600.
+    else:
         sigma_ra, sigma_dec, sigma_total = -99, -99, -99
-        pass
 
     def make_valid(x):
         return x if numpy.isfinite(x) else -9999
@@ -2714,8 +3421,7 @@ if __name__ == "__main__":
         src_cat = numpy.loadtxt(get_clean_cmdline()[1])
         ref_cat = numpy.loadtxt(get_clean_cmdline()[2])
 
-        center_ra = numpy.median(src_cat[:,0])
-        center_dec = numpy.median(src_cat[:,1])
+        center_ra, center_dec = numpy.median(src_cat[:,0:2], axis=0)
         angle = float(get_clean_cmdline()[3])
         src_rotated = rotate_shift_catalog(src_cat, (center_ra, center_dec), angle, None)
 
@@ -48,12 +48,18 @@ from astLib import astWCS
 import pdb
 import scipy
 import scipy.stats
+import scipy.spatial
 
 
 import podi_search_ipprefcat
 import podi_findstars
 import matplotlib.pyplot as pl
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 arcsec = 1./3600.
 number_bright_stars = 100
 max_offset = 0.1
@@ -116,6 +122,32 @@ def compute_wcs_quality(odi_2mass_matched, ota, hdr=None):
 
 
 
+if (numba is not None):
+    @numba.njit(cache=True, parallel=True, fastmath=True)
+    def _score_shifts(ota_scaled, ref_scaled, cand_shifts, max_d2, counts):
+        """
+
+        Count, for every candidate shift, all close OTA/reference
+        pairings - the hot kernel of count_matches. Written as explicit
+        loops so numba can run the hypotheses in parallel without
+        allocating any shifted-catalog temporaries.
+
+        """
+        n_ota = ota_scaled.shape[0]
+        n_ref = ref_scaled.shape[0]
+        for s in numba.prange(cand_shifts.shape[0]):
+            c = 0
+            for k in range(n_ota):
+                ax = ota_scaled[k,0] + cand_shifts[s,0]
+                ay = ota_scaled[k,1] + cand_shifts[s,1]
+                for l in range(n_ref):
+                    dx = ax - ref_scaled[l,0]
+                    dy = ay - ref_scaled[l,1]
+                    if (dx*dx + dy*dy < max_d2):
+                        c += 1
+            counts[s] = c
+
+
 def count_matches(ota_x, ota_y, ref_x, ref_y, verbose=False, max_offset=0.1, matching_radius_arcsec=3.6):
 
     ota_count = ota_x.shape[0]
@@ -123,20 +155,8 @@ def count_matches(ota_x, ota_y, ref_x, ref_y, verbose=False, max_offset=0.1, mat
     # print "Using %d and %d stars in shift_align_wcs" % (ota_count, ref_count)
 
     matching_radius = matching_radius_arcsec * arcsec
-    max_d2 = matching_radius * matching_radius
-
-    if (verbose): print("Matching radius",matching_radius, max_d2)
-    
-    index_ota = numpy.arange(ota_count).reshape((ota_count,1)).repeat(ref_count, axis=1)
-    index_ref = numpy.arange(ref_count).reshape((1,ref_count)).repeat(ota_count, axis=0)
-    #print index_ota[0:10,0:10]
-    #print index_ref[0:10,0:10]
-    #print index_ota.shape, index_ref.shape
 
-    #print index_ota[280,150], index_ref[280,150]
-
-    match_results = numpy.zeros(shape=(ota_count, ref_count, 3))
-    match_results[:,:,:] = numpy.NaN
+    if (verbose): print("Matching radius",matching_radius)
 
     #for o in range(ota_count):
     #    print "PO",ota_x[o], ota_y[o]
@@ -144,65 +164,56 @@ def count_matches(ota_x, ota_y, ref_x, ref_y, verbose=False, max_offset=0.1, mat
     #for r in range(ref_count):
     #    print "PR",ref_x[r], ref_y[r]
 
-    matched_pair = 0
-    
     median_delta = numpy.median(ref_y)
     cos_delta = math.cos(math.radians(median_delta))
 
-    for o in range(ota_count):
-        for r in range(ref_count):
-            
-            # Take some random shift
-            shift_dx = ref_x[r] - ota_x[o]
-            shift_dy = ref_y[r] - ota_y[o]
-            if (math.fabs(shift_dx*cos_delta) > max_offset or math.fabs(shift_dy) > max_offset):
-                continue
-
-            # Apply shift to OTA coordinates
-            aligned_x = ota_x + shift_dx
-            aligned_y = ota_y + shift_dy
-
-            # Compute distance between every star in the OTA 
-            # to every star in the reference frame
-
-            dx1 = aligned_x.reshape((ota_count, 1)).repeat(ref_count, axis=1)
-            dx2 = ref_x.reshape((1, ref_count)).repeat(ota_count, axis=0)
-            dx = dx1 - dx2
-            #print dx.shape
-
-            dy1 = aligned_y.reshape((ota_count, 1)).repeat(ref_count, axis=1)
-            dy2 = ref_y.reshape((1, ref_count)).repeat(ota_count, axis=0)
-            dy = dy1 - dy2
-            #print dy.shape
-
-            d2 = dx*dx*cos_delta**2 + dy*dy
-            #print d.shape
-
-            close_match = d2 < max_d2
-            matched = numpy.sum(close_match)
-
-            match_results[o,r,0] = matched
-            match_results[o,r,1] = shift_dx
-            match_results[o,r,2] = shift_dy
-
-            #print "X_DXDY_count",o, r, shift_dx, shift_dy, matched
-            if (matched > 1 and False):
-                idx_ota, idx_ref = index_ota[close_match], index_ref[close_match]
-                #print idx_ota.shape, idx_ref.shape
-                for match in range(idx_ota.shape[0]):
-                    print("MATCH_%d"%(matched_pair),ota_x[idx_ota[match]], ota_y[idx_ota[match]], \
-                        ref_x[idx_ref[match]], ref_y[idx_ref[match]], shift_dx, shift_dy)
-
-                matched_pair += 1
-                pass
-
-    #
-    # Now that we have the counts for all pairs, find out some 
-    # median background level of the number of (random) matches
-    #
-    good_datapoints = numpy.isfinite(match_results[:,:,0])
-
-    selected_matches = match_results[good_datapoints]
+    # All distances are measured with Ra scaled by cos(declination), so
+    # work in that scaled frame throughout
+    ref_scaled = numpy.column_stack([ref_x * cos_delta, ref_y])
+    ota_scaled = numpy.column_stack([ota_x * cos_delta, ota_y])
+
+    # Enumerate all candidate shifts - one per ota/reference pairing - in
+    # a single broadcast and apply the max_offset window up front, rather
+    # than looping over all ota x ref combinations in python just to
+    # discard most of them
+    shift_dx = ref_x[None,:] - ota_x[:,None]
+    shift_dy = ref_y[None,:] - ota_y[:,None]
+    plausible = (numpy.fabs(shift_dx * cos_delta) <= max_offset) \
+                & (numpy.fabs(shift_dy) <= max_offset)
+    # resolve the packed mask into flat candidate indices once; take()
+    # gathers the surviving shifts in a single pass each, and every
+    # downstream consumer works off this candidate list
+    candidates = numpy.flatnonzero(plausible.ravel())
+    cand_dx = shift_dx.ravel().take(candidates)
+    cand_dy = shift_dy.ravel().take(candidates)
+
+    cand_shifts = numpy.column_stack([cand_dx * cos_delta, cand_dy])
+    counts = numpy.empty(cand_shifts.shape[0])
+    if (numba is not None):
+        # score all hypotheses in the compiled kernel, parallel across
+        # hypotheses and free of shifted-catalog temporaries
+        _score_shifts(ota_scaled, ref_scaled, cand_shifts,
+                      matching_radius * matching_radius, counts)
+    else:
+        # Score the surviving hypotheses in blocks against a kd-tree on
+        # the reference positions, counting all close OTA/reference
+        # pairings for a whole block of shifted catalogs with a single
+        # query; the block size keeps the shifted-coordinate array at a
+        # manageable size
+        ref_tree = scipy.spatial.cKDTree(ref_scaled)
+        shift_blocksize = 1024
+        for start in range(0, cand_shifts.shape[0], shift_blocksize):
+            block = cand_shifts[start:start+shift_blocksize]
+            aligned = (ota_scaled[None,:,:] + block[:,None,:]).reshape((-1,2))
+            n_close = ref_tree.query_ball_point(
+                aligned, matching_radius, return_length=True)
+            counts[start:start+shift_blocksize] = \
+                n_close.reshape((block.shape[0], -1)).sum(axis=1)
+
+    # every candidate has a valid count, so the (count, dx, dy) table
+    # follows directly - no need for the full ota x ref result cube that
+    # was only scattered into and immediately compressed again
+    selected_matches = numpy.column_stack([counts, cand_dx, cand_dy])
     if (verbose): print("Selected matches=",selected_matches.shape)
 
     return selected_matches
@@ -216,9 +227,10 @@ def shift_align_wcs(ota_x, ota_y, ref_x, ref_y, verbose=False, max_offset=0.1):
         # No matches found, return no shift and signal that the solution is invalid (Nmatch<0) 
         return 0, 0, -1, None
         
-    median = numpy.median(selected_matches[:,0])
+    # one partition pass yields both quantiles
+    median, q84 = numpy.percentile(selected_matches[:,0], [50, 84])
     std = numpy.std(selected_matches[:,0])
-    sigma = scipy.stats.scoreatpercentile(selected_matches[:,0], 84) - median
+    sigma = q84 - median
 
     if (verbose): print("MATCH-RESULTS:")
     if (verbose): print("Random matches:",median,"+/-",std,"   (",sigma,")")
@@ -280,6 +292,15 @@ def refine_wcs_shift(ref_x, ref_y, ota_x, ota_y, best_guess,
     #pl.title("refine_wcs_shift:   Reference/OTA after shift")
     #pl.show(block=True)
 
+    # Finding the closest reference star for every source is a plain
+    # 1-NN problem, so build a kd-tree on the reference catalog once and
+    # let it answer all blocks - no more full (block x ref) distance
+    # matrix per block. x (=RA) needs to be multiplied with
+    # cos(declination) to prevent problems at large declinations.
+    cos_dec = math.cos(math.radians(numpy.median(ref_y)))
+    ref_tree = scipy.spatial.cKDTree(
+        numpy.column_stack([ref_x * cos_dec, ref_y]))
+
     start = 0
     while(start < ota_x.shape[0]):
 
@@ -288,39 +309,27 @@ def refine_wcs_shift(ref_x, ref_y, ota_x, ota_y, best_guess,
         aligned_y = full_aligned_y[start:start+blocksize]
 
         #
-        # Compute distances between each star in the OTA subsample and the full reference catalog
+        # Find the closest reference star for each star in the subsample
         #
+        d, closest = ref_tree.query(
+            numpy.column_stack([aligned_x * cos_dec, aligned_y]), k=1)
 
-        # x (=RA) needs to be multiplied with cos(declination) 
-        # to prevent problems at large declinations
-        dx1 = aligned_x.reshape((aligned_x.shape[0], 1)).repeat(ref_x.shape[0], axis=1)
-        dx2 = ref_x.reshape((1, ref_x.shape[0])).repeat(aligned_x.shape[0], axis=0)
-        dx = (dx2 - dx1) * numpy.cos(numpy.radians(dx1))
+        dx = (ref_x[closest] - aligned_x) * cos_dec
+        dy = ref_y[closest] - aligned_y
 
-        # No special treatment for declinations (=y) necessary
-        dy1 = aligned_y.reshape((aligned_y.shape[0], 1)).repeat(ref_y.shape[0], axis=1)
-        dy2 = ref_y.reshape((1, ref_y.shape[0])).repeat(aligned_y.shape[0], axis=0)
-        dy = dy2 - dy1
-
-        # Compute distances between them
-        d2 = dx*dx + dy*dy
+        # Compute the vector from each OTA star to the closest star in the reference catalog
+        n_block = closest.shape[0]
+        matches[start:start+n_block,0] = dx
+        matches[start:start+n_block,1] = dy
 
-        # And sort them by distance
-        closest = numpy.argmin(d2, axis=1)
+        # Save the coordinate pairs and which reference star is the closest match
+        matched[start:start+n_block,:] = numpy.column_stack(
+            [aligned_x, aligned_y, ref_x[closest], ref_y[closest],
+             numpy.arange(start, start+n_block), closest,
+             ota_px_x[start:start+n_block], ota_px_y[start:start+n_block]])
 
-        # Compute the vector from each OTA star to the closest star in the reference catalog
         x = open("dump2", "a")
-        for i in range(closest.shape[0]):
-            matches[start+i,0] = dx[i, closest[i]]
-            matches[start+i,1] = dy[i, closest[i]]
-            #print matches[start+i,:]
-
-            # Save the coordinate pairs and which reference star is the closest match
-#            matched[start+i,0:6] = [aligned_x[i], aligned_y[i], ref_x[closest[i]], ref_y[closest[i]], start+i, closest[i]]
-            matched[start+i,:] = [aligned_x[i], aligned_y[i], ref_x[closest[i]],
-                                  ref_y[closest[i]], start+i, closest[i], ota_px_x[start+i], ota_px_y[start+i] ]
-            print(aligned_x[i], aligned_y[i], ref_x[closest[i]], ref_y[closest[i]],
-                  start+i, closest[i], ota_px_x[start+i], ota_px_y[start+i], file=x)
+        numpy.savetxt(x, matched[start:start+n_block])
         x.close()
 
         start += blocksize
@@ -335,31 +344,20 @@ def refine_wcs_shift(ref_x, ref_y, ota_x, ota_y, best_guess,
     #return 0, matched, matches
 
     dmin, dmax = [-matching_radius*arcsec, -matching_radius*arcsec], [matching_radius*arcsec, matching_radius*arcsec]
-    clipping = matches.copy()
-    for rep in range(2):
-        valid_range = (clipping[:,0] < dmax[0]) & (clipping[:,0] > dmin[0]) & (clipping[:,1] > dmin[1]) & (clipping[:,1] < dmax[1])
-        if (verbose): print("valid_range.shape=",valid_range.shape)
-        if (verbose): print("count=",numpy.sum(valid_range))
-
-        if (numpy.sum(valid_range) <= 0):
-            median = [0,0]
-            break
-
-        median = numpy.median(clipping[valid_range], axis=0)
-        sigma_p = scipy.stats.scoreatpercentile(clipping[valid_range], 84)
-        sigma_m = scipy.stats.scoreatpercentile(clipping[valid_range], 16)
-        sigma = 0.5*(sigma_p - sigma_m)
-        dmin = median - 3*sigma
-        dmax = median + 3*sigma
-        if (verbose): print("MEDIAN/SIGMA=",median, sigma, dmin, dmax)
+    median = clipped_median_shift(matches, dmin, dmax, verbose=verbose)
 
     #
     # Dump some info into a file for later analysis and potentially plotting
     #
     if (alignment_checkfile is not None):
-        for i in range(matched.shape[0]):
-            print (matched[i,0], matched[i,1], matched[i,2], matched[i,3], ext,
-                matched[i,0]-median[0],matched[i,1]-median[1],matches[i,0], matches[i,1], file=alignment_checkfile)
+        # assemble all columns once and write the block in a single
+        # savetxt call instead of formatting row by row in python
+        block = numpy.column_stack(
+            [matched[:,0:4],
+             numpy.full((matched.shape[0],), ext),
+             matched[:,0]-median[0], matched[:,1]-median[1],
+             matches[:,0], matches[:,1]])
+        numpy.savetxt(alignment_checkfile, block)
         print("\n\n\n\n\n", file=alignment_checkfile)
 
     if (verbose): print("Ref: %d, ODI: %d, Matched: %d" % (ref_x.shape[0], ota_x.shape[0], matched.shape[0]))
@@ -374,21 +372,57 @@ def pick_brightest(ra, dec, mag, N):
     if (N >= ra.shape[0]):
         return ra, dec, mag
     
-    magsort = numpy.argsort(mag)
+    # argpartition finds the N brightest in linear time; only those N
+    # then need the full sort to keep the brightest-first ordering.
+    # fancy-indexing with the top-N positions copies all three columns
+    # in one go - no per-star python loop
+    brightest = numpy.argpartition(mag, N)[:N]
+    magsort = brightest[numpy.argsort(mag[brightest])]
+
+    return ra[magsort], dec[magsort], mag[magsort]
+
+
+
 
-    _ra = numpy.zeros(shape=(N,))
-    _dec = numpy.zeros(shape=(N,))
-    _mag = numpy.zeros(shape=(N,))
 
-    for i in range(N):
-        _ra[i] = ra[magsort[i]]
-        _dec[i] = dec[magsort[i]]
-        _mag[i] = mag[magsort[i]]
+def clipped_median_shift(clipping, dmin, dmax, nrep=2, verbose=False):
+    """
 
-    return _ra, _dec, _mag
+    Iteratively sigma-clip a (N,2) dx/dy shift distribution. Each pass
+    selects all points inside the current window, derives the per-axis
+    16th/50th/84th percentiles in a single partition pass and tightens
+    the window to median +/- 3 sigma. Returns the final per-axis median,
+    or [0,0] if no points survive the initial window.
 
+    """
 
+    median = [0,0]
+    # one reusable work buffer; clipped rows are NaN'd out and the
+    # statistics computed with nanpercentile, so no shrinking copy of
+    # the survivors is allocated in each pass
+    work = numpy.empty(clipping.shape)
+    for rep in range(nrep):
+        valid_range = (clipping[:,0] < dmax[0]) & (clipping[:,0] > dmin[0]) \
+                    & (clipping[:,1] > dmin[1]) & (clipping[:,1] < dmax[1])
+        if (verbose): print("valid_range.shape=",valid_range.shape)
+        if (verbose): print("count=",numpy.sum(valid_range))
 
+        if (numpy.sum(valid_range) <= 0):
+            median = [0,0]
+            break
+
+        numpy.copyto(work, clipping)
+        work[~valid_range] = numpy.NaN
+
+        # all three quantiles from a single partition pass, per axis
+        sigma_m, median, sigma_p = \
+            numpy.nanpercentile(work, [16, 50, 84], axis=0)
+        sigma = 0.5*(sigma_p - sigma_m)
+        dmin = median - 3*sigma
+        dmax = median + 3*sigma
+        if (verbose): print("MEDIAN/SIGMA=",median, sigma, dmin, dmax)
+
+    return median
 
 
 def get_overall_best_guess(frame_shift):
@@ -401,22 +435,8 @@ def get_overall_best_guess(frame_shift):
     #print full_shift,full_shift_std
 
     dmin, dmax = [-1, -1], [1,1]
-    clipping = frame_shift.copy()
     #print full_shift,full_shift_std,dmin,dmax
-    for rep in range(2):
-        valid_range \
-            = (clipping[:,0] < dmax[0]) & (clipping[:,0] > dmin[0]) \
-            & (clipping[:,1] > dmin[1]) & (clipping[:,1] < dmax[1])
-               
-        median = numpy.median(clipping[valid_range], axis=0)
-        sigma_p = scipy.stats.scoreatpercentile(clipping[valid_range], 84)
-        sigma_m = scipy.stats.scoreatpercentile(clipping[valid_range], 16)
-        sigma = 0.5*(sigma_p - sigma_m)
-        dmin = median - 3*sigma
-        dmax = median + 3*sigma
-        print(median, sigma, dmin, dmax)
-
-    best_guess = median
+    best_guess = clipped_median_shift(frame_shift, dmin, dmax, verbose=True)
     print("Best shift solution so far:",best_guess)
     return best_guess
 
@@ -447,14 +467,17 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
             print(usno[i, 0], usno[i, 1], file=usno_dump)
         usno_dump.close()
 
-        ref_ra = usno[:,0]
-        ref_dec = usno[:,1]
-        ref_mag = usno[:,4]
+        # contiguous copies - the matching kernels below hit these
+        # columns over and over, and a strided view into the wide
+        # catalog matrix wastes most of every cache line
+        ref_ra = numpy.ascontiguousarray(usno[:,0])
+        ref_dec = numpy.ascontiguousarray(usno[:,1])
+        ref_mag = numpy.ascontiguousarray(usno[:,4])
     else:
         ipp_cat = podi_search_ipprefcat.get_reference_catalog(ra, dec, 0.7, IPP_DIR)
-        ref_ra = ipp_cat[:,0]
-        ref_dec = ipp_cat[:,1]
-        ref_mag = ipp_cat[:,3]
+        ref_ra = numpy.ascontiguousarray(ipp_cat[:,0])
+        ref_dec = numpy.ascontiguousarray(ipp_cat[:,1])
+        ref_mag = numpy.ascontiguousarray(ipp_cat[:,3])
 
     if (starfinder == "sextractor"):
         #
@@ -487,10 +510,10 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
             print(sex_cat[i, 6], sex_cat[i, 7], file=sex_dump)
         sex_dump.close()
 
-        odi_ra = sex_cat[:,6]
-        odi_dec = sex_cat[:,7]
-        odi_mag = sex_cat[:,2]
-        odi_ota = sex_cat[:,1]
+        odi_ra = numpy.ascontiguousarray(sex_cat[:,6])
+        odi_dec = numpy.ascontiguousarray(sex_cat[:,7])
+        odi_mag = numpy.ascontiguousarray(sex_cat[:,2])
+        odi_ota = numpy.ascontiguousarray(sex_cat[:,1])
     else:
         full_source_cat = None
         for ext in range(1, len(hdulist)):
@@ -505,10 +528,10 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
             
         # Now all OTAs have been searched        
 
-        odi_ra = full_source_cat[:,0]
-        odi_dec = full_source_cat[:,1]
+        odi_ra = numpy.ascontiguousarray(full_source_cat[:,0])
+        odi_dec = numpy.ascontiguousarray(full_source_cat[:,1])
         odi_mag = -2.5 * numpy.log10(full_source_cat[:,6]) + 30
-        odi_ota = full_source_cat[:,7]
+        odi_ota = numpy.ascontiguousarray(full_source_cat[:,7])
 
 
     #
@@ -517,6 +540,21 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
     #
     frame_shift = numpy.ones(shape=(len(hdulist)-1, 2)) * -999
     global_number_matches = None
+
+    # The search-box size is the same for all extensions, and sorting the
+    # reference catalog by Ra once lets every extension select its Ra
+    # range with two binary searches instead of re-scanning the full
+    # catalog four times per OTA
+    width_ra = 0.1/math.cos(numpy.radians(dec))
+    width_dec = 0.1
+    print("RA-Range:",ra-width_ra,ra+width_ra)
+    print("DEC-Range:",dec-width_dec,dec+width_dec)
+
+    ref_ra_order = numpy.argsort(ref_ra)
+    ref_ra_sorted = ref_ra[ref_ra_order]
+    ref_dec_sorted = ref_dec[ref_ra_order]
+    ref_mag_sorted = ref_mag[ref_ra_order]
+
     for ext in range(1, len(hdulist)):
         #
         # Select a sub-catalog with stars in this OTA
@@ -541,13 +579,14 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
         # Compute the median central position of this OTA
         #
         #center_ra, center_dec
-        centerx, centery = hdulist[ext].header['NAXIS1']/2, hdulist[ext].header['NAXIS2']/2
-        ota_center_ra  = (centerx-hdulist[ext].header['CRPIX1'])*hdulist[ext].header['CD1_1'] \
-            + (centery-hdulist[ext].header['CRPIX2'])*hdulist[ext].header['CD1_2'] \
-            + hdulist[ext].header['CRVAL1']
-        ota_center_dec = (centerx-hdulist[ext].header['CRPIX1'])*hdulist[ext].header['CD2_1'] \
-            + (centery-hdulist[ext].header['CRPIX2'])*hdulist[ext].header['CD2_2'] \
-            + hdulist[ext].header['CRVAL2']
+        hdr = hdulist[ext].header
+        centerx, centery = hdr['NAXIS1']/2, hdr['NAXIS2']/2
+        ota_center_ra  = (centerx-hdr['CRPIX1'])*hdr['CD1_1'] \
+            + (centery-hdr['CRPIX2'])*hdr['CD1_2'] \
+            + hdr['CRVAL1']
+        ota_center_dec = (centerx-hdr['CRPIX1'])*hdr['CD2_1'] \
+            + (centery-hdr['CRPIX2'])*hdr['CD2_2'] \
+            + hdr['CRVAL2']
         print("center:", ra, dec)
 
 
@@ -555,21 +594,18 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
         # Now select stars that are within a given distance of this OTA
         # Assume a (half-)width of 6 arcmin, that's quite a bit larger than the 4armin of one OTA
         #
-        width_ra = 0.1/math.cos(numpy.radians(dec))
-        width_dec = 0.1
-        print("RA-Range:",ra-width_ra,ra+width_ra)
-        print("DEC-Range:",dec-width_dec,dec+width_dec)
-
         min_ra = ota_center_ra - width_ra
         max_ra = ota_center_ra + width_ra
         min_dec = ota_center_dec - width_dec
         max_dec = ota_center_dec + width_dec
         # Add here: Treatment in the case of ra <~ 0
 
-        ref_this_ota = (ref_ra > min_ra) & (ref_ra < max_ra) & (ref_dec > min_dec) & (ref_dec < max_dec)
-        ota_ref_ra = ref_ra[ref_this_ota]
-        ota_ref_dec = ref_dec[ref_this_ota]
-        ota_ref_mag = ref_mag[ref_this_ota]
+        lo = numpy.searchsorted(ref_ra_sorted, min_ra, 'right')
+        hi = numpy.searchsorted(ref_ra_sorted, max_ra, 'left')
+        in_dec = (ref_dec_sorted[lo:hi] > min_dec) & (ref_dec_sorted[lo:hi] < max_dec)
+        ota_ref_ra = ref_ra_sorted[lo:hi][in_dec]
+        ota_ref_dec = ref_dec_sorted[lo:hi][in_dec]
+        ota_ref_mag = ref_mag_sorted[lo:hi][in_dec]
 
         #
         # Make sure we have not too few and not too many reference stars to work with
@@ -653,10 +689,14 @@ def fixwcs(fitsfile, output_filename, starfinder="findstars", refcatalog="ippref
             hdulist[ext].header['CRVAL2'] += full_shift[1]
 
             # Add some HISTORY comments to keep track of what's happening
-            hdulist[ext].header.add_history("GLOBAL SHIFT: dRA,dDEC=")
-            hdulist[ext].header.add_history("dRA=%.6f dDEC=%.6f" % (best_guess[0], best_guess[1]))
-            hdulist[ext].header.add_history("LOCAL SHIFT: dRA,dDEC=")
-            hdulist[ext].header.add_history("dRA=%.6f dDEC=%.6f" % (median[0], median[1]))
+            # extend() appends all four cards in one call, so the header
+            # is re-serialized once instead of once per card
+            hdulist[ext].header.extend([
+                pyfits.Card('HISTORY', "GLOBAL SHIFT: dRA,dDEC="),
+                pyfits.Card('HISTORY', "dRA=%.6f dDEC=%.6f" % (best_guess[0], best_guess[1])),
+                pyfits.Card('HISTORY', "LOCAL SHIFT: dRA,dDEC="),
+                pyfits.Card('HISTORY', "dRA=%.6f dDEC=%.6f" % (median[0], median[1])),
+            ])
     else:
 
         # Compute the refinement for the full source catalog across all OTAs
@@ -70,6 +70,11 @@ from podi_definitions import *
 from podi_commandline import *
 import podi_imcombine
 import podi_fitskybackground
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 import time
 
 avg_sky_countrates = {
@@ -85,6 +90,175 @@ import logging
 
 import podi_illumcorr
 
+def normalize_fringe(data, skylevel):
+    """
+
+    Compute the normalized fringe signal (data - skylevel) / skylevel as
+    a float32 array. With numexpr available the whole expression runs in
+    one threaded, cache-blocked pass; otherwise fall back to an in-place
+    float32 subtract and reciprocal-multiply.
+
+    """
+
+    if (numexpr is not None):
+        fringing = numpy.empty(data.shape, dtype=numpy.float32)
+        numexpr.evaluate("(d - s) * r",
+                         local_dict={'d': data,
+                                     's': numpy.float32(skylevel),
+                                     'r': numpy.float32(1./skylevel)},
+                         out=fringing, casting='same_kind')
+        return fringing
+
+    fringing = data.astype(numpy.float32)
+    numpy.subtract(fringing, numpy.float32(skylevel), out=fringing)
+    numpy.multiply(fringing, numpy.float32(1./skylevel), out=fringing)
+    return fringing
+
+
+def combine_fringe_stripe(stack, operation):
+    """
+
+    Reduce one (n_frames, rows, columns) stripe of normalized fringe
+    data along the frame axis. Supports the simple pixel-wise combine
+    operations; returns None for operations that need the full
+    imcombine machinery.
+
+    """
+
+    if (operation == "nanmedian.bn"):
+        return bottleneck.nanmedian(stack, axis=0)
+    elif (operation == "nanmean.bn"):
+        return bottleneck.nanmean(stack, axis=0)
+    elif (operation == "nanmedian"):
+        return numpy.nanmedian(stack, axis=0)
+    elif (operation == "nanmean"):
+        return numpy.nanmean(stack, axis=0)
+    elif (operation == "median"):
+        return numpy.median(stack, axis=0)
+    elif (operation == "mean"):
+        return numpy.mean(stack, axis=0)
+    elif (operation == "min"):
+        return numpy.min(stack, axis=0)
+    elif (operation == "max"):
+        return numpy.max(stack, axis=0)
+    return None
+
+
+def parallel_combine_fringe_ota(task):
+    """
+
+    Worker for make_fringing_template: median-combine the normalized
+    fringe signal of a single extension across all prepared input frames.
+    Each worker re-opens the (memory-mapped) prepared files by name and
+    addresses the extension by its precomputed HDU index, so only
+    filenames and indices travel between processes. The combine streams
+    over row stripes, so only one stripe of every input frame is in
+    memory at a time rather than the full normalized stack.
+
+    """
+
+    extname, file_exts, skymode, operation = task
+
+    # First pass touches only the headers: find the frames that
+    # contribute to this OTA and remember their sky levels
+    contributors = []
+    for filename, ext_id in file_exts:
+
+        try:
+            # memmap guarantees lazy access - only the stripes we
+            # read are ever paged in; the prepared frames are plain float
+            # images, so skipping the BSCALE/BZERO machinery is safe
+            hdulist = pyfits.open(filename, memmap=True,
+                                  do_not_scale_image_data=True)
+            this_hdu = hdulist[ext_id]
+        except:
+            continue
+
+        # Skip all OTAs that are marked as video/guide OTAs
+        cellmode = this_hdu.header['CELLMODE']
+        if (cellmode.find("V") >= 0):
+            hdulist.close()
+            continue
+
+        skylevel = this_hdu.header['SKY_MEDI']
+
+        if (skymode == 'global'):
+            skylevel = hdulist[0].header['SKYLEVEL']
+        if ("EXPTIME" in hdulist[0].header):
+            exptime = hdulist[0].header['EXPTIME']
+            filter = hdulist[0].header['FILTER']
+            if (filter in avg_sky_countrates):
+                max_skylevel = 2 * avg_sky_countrates[filter] * exptime
+                if (skylevel > max_skylevel):
+                    hdulist.close()
+                    continue
+
+        contributors.append((hdulist, this_hdu, skylevel))
+
+    if (len(contributors) <= 0):
+        return extname, None
+
+    if (combine_fringe_stripe(
+            numpy.zeros((1,1,1), dtype=numpy.float32), operation) is None):
+        # exotic combine operation: materialize the full stack and use
+        # the general imcombine machinery
+        data_blocks = [normalize_fringe(this_hdu.data, skylevel)
+                       for hdulist, this_hdu, skylevel in contributors]
+        combined = podi_imcombine.imcombine_data(data_blocks, operation)
+    else:
+        # stream the combine in stripes of rows: normalize each frame's
+        # stripe into a fixed stack buffer and reduce it immediately, so
+        # peak memory is one stripe per frame instead of the full stack
+        shape = (contributors[0][1].header['NAXIS2'],
+                 contributors[0][1].header['NAXIS1'])
+        combined = numpy.empty(shape, dtype=numpy.float32)
+        stripe_height = 256
+        stack = numpy.empty((len(contributors), stripe_height, shape[1]),
+                            dtype=numpy.float32)
+        for y in range(0, shape[0], stripe_height):
+            n_rows = min(stripe_height, shape[0]-y)
+            for k, (hdulist, this_hdu, skylevel) in enumerate(contributors):
+                stack[k, :n_rows, :] = \
+                    normalize_fringe(this_hdu.data[y:y+n_rows, :], skylevel)
+            combined[y:y+n_rows, :] = \
+                combine_fringe_stripe(stack[:, :n_rows, :], operation)
+
+    for hdulist, this_hdu, skylevel in contributors:
+        hdulist.close()
+
+    return extname, combined
+
+
+def parallel_correct_ota(task):
+    """
+
+    Pool worker for the stand-alone -correct mode: subtract the scaled
+    fringe template from a single extension and return the corrected
+    pixel data to the main process.
+
+    """
+    inputframe, template, extname, scaling = task
+
+    inputhdu = pyfits.open(inputframe, memmap=True)
+    templatehdu = pyfits.open(template, memmap=True)
+
+    try:
+        # keep the scaled template in float32 - the data frames
+        # are float32, and a float64 fringe map would double the
+        # memory traffic of the subtraction
+        fringemap = templatehdu[extname].data.astype(numpy.float32, copy=False) \
+                    * numpy.float32(scaling)
+        corrected = inputhdu[extname].data - fringemap
+    except:
+        print("Problem with extension",extname)
+        corrected = None
+
+    inputhdu.close()
+    templatehdu.close()
+
+    return extname, corrected
+
+
 def make_fringing_template(input_filelist, outputfile, return_hdu=False, 
                            skymode='local', operation="nanmedian.bn",
                            bpm_dir=None, wipe_cells=None, ocdclean=False,
@@ -205,15 +379,29 @@ def make_fringing_template(input_filelist, outputfile, return_hdu=False,
 
     #
     # Now loop over all extensions and compute the mean
+    # Each extension combines independently of all others, so hand the
+    # per-OTA work to a pool of worker processes (see
+    # parallel_combine_fringe_ota); workers re-open the prepared files
+    # themselves, keeping the task payload small
     #
+    # Map extension names to HDU indices once per prepared file; looking
+    # up an extension by name scans the HDU list linearly, and doing so
+    # once per OTA and file adds up to thousands of scans
+    ext_maps = []
+    for filename in masked_list:
+        with pyfits.open(filename) as prepared:
+            ext_maps.append(
+                dict([(hdu.name, i) for i, hdu in enumerate(prepared)]))
+
+    combine_tasks = []
+    combine_exts = []
     for extid, ext in enumerate(ref_hdulist):
 
         # Check what OTA we are dealing with
         if (not is_image_extension(ext)):
             continue
 
-        data_blocks = []
-        extname = ext.name 
+        extname = ext.name
 
         if (filtername in fpl.otas_for_photometry):
             useful_otas = fpl.otas_for_photometry[filtername]
@@ -221,56 +409,35 @@ def make_fringing_template(input_filelist, outputfile, return_hdu=False,
             if (not ota_id in useful_otas):
                 continue
 
-        stdout_write("\rCombining frames for OTA %s (#%2d/%2d) ..." % (extname, extid, len(ref_hdulist)))
-
-        # Now open all the other files, look for the right extension, and copy their image data to buffer
-        #for file_number in range(0, len(filelist)):
-        for filename in masked_list: # hdu_filelist:
-
-            try:
-                hdulist = pyfits.open(filename)
-                this_hdu = hdulist[extname]
-            except:
-                continue
-
-            # Skip all OTAs that are marked as video/guide OTAs
-            cellmode = this_hdu.header['CELLMODE']
-            if (cellmode.find("V") >= 0):
-                continue
-            
-            skylevel = this_hdu.header['SKY_MEDI']
-
-            if (skymode == 'global'):
-                skylevel = hdulist[0].header['SKYLEVEL']
-            if ("EXPTIME" in hdulist[0].header):
-                exptime = hdulist[0].header['EXPTIME']
-                filter = hdulist[0].header['FILTER']
-                if (filter in avg_sky_countrates):
-                    max_skylevel = 2 * avg_sky_countrates[filter] * exptime
-                    if (skylevel > max_skylevel):
-                        stdout_write(" (%.1f)" % (skylevel/exptime))
-                        continue
-
-            fringing = (this_hdu.data - skylevel) / skylevel
-            stdout_write(" %.1f" % (skylevel/exptime))
-            data_blocks.append(fringing)
-
-            # delete the data block to free some memory, since we won't need it anymore
-            hdulist.close()
-
-        stdout_write(" combining ...")
-        #combined = podi_imcombine.imcombine_data(data_blocks, "nanmedian")
-        combined = podi_imcombine.imcombine_data(data_blocks, operation) #"nanmedian.bn")
-
+        file_exts = [(masked_list[i], ext_maps[i][extname])
+                     for i in range(len(masked_list))
+                     if (extname in ext_maps[i])]
+        combine_tasks.append((extname, file_exts, skymode, operation))
+        combine_exts.append(ext)
+
+    logger.info("Combining %d extensions using %d parallel processes" % (
+        len(combine_tasks), sitesetup.number_cpus))
+
+    # maxtasksperchild=1 makes sure the memory held by one OTA's data
+    # blocks is returned to the system before the next OTA starts
+    pool = multiprocessing.Pool(processes=sitesetup.number_cpus,
+                                maxtasksperchild=1)
+    combined_data = {}
+    for extname, combined in pool.imap_unordered(parallel_combine_fringe_ota,
+                                                 combine_tasks):
+        logger.debug("Received combined fringe template for %s" % (extname))
+        combined_data[extname] = combined
+    pool.close()
+    pool.join()
+
+    for ext in combine_exts:
         # Create new ImageHDU
         # Insert the imcombine'd frame into the output HDU
         # Copy all headers from the reference HDU
-        # stdout_write(" creating HDU ...")
-        hdu = pyfits.ImageHDU(header=ext.header, data=combined)
+        hdu = pyfits.ImageHDU(header=ext.header, data=combined_data[ext.name])
 
         # Append the new HDU to the list of result HDUs
         out_hdulist.append(hdu)
-        stdout_write(" done!\n")
 
         del hdu
 
@@ -583,7 +750,7 @@ if __name__ == "__main__":
 
                 skylevel = hdulist[ext].header['SKY_MEDI']
                 
-                fringing = (hdulist[ext].data - skylevel) / skylevel
+                fringing = normalize_fringe(hdulist[ext].data, skylevel)
                 stdout_write("   %s = %.1f\n" % (hdulist[ext].header['EXTNAME'], skylevel))
 
                 out_hdu.append(pyfits.ImageHDU(header=hdulist[ext].header,
@@ -625,7 +792,7 @@ if __name__ == "__main__":
                 stdout_write("\rWorking on %s ..." % (extname))
                 regions = numpy.array(podi_fitskybackground.sample_background(hdulist[i].data, None, None, min_found=count, boxwidth=boxsize))
                 
-                median = numpy.median(regions[:,4])
+                median = bottleneck.nanmedian(regions[:,4])
                 std = numpy.std(regions[:,4])
 
 
@@ -662,22 +829,27 @@ if __name__ == "__main__":
         output = get_clean_cmdline()[4]
 
         inputhdu = pyfits.open(inputframe)
-        templatehdu = pyfits.open(template)
 
+        # The per-extension corrections are independent of each other,
+        # so farm them out to a pool of workers; each worker re-opens
+        # the files memory-mapped and only the corrected pixel data
+        # travels back to this process. Writing stays serial.
+        correct_tasks = []
         for i in range(len(inputhdu)):
             if (not is_image_extension(inputhdu[i])):
                 continue
-
             extname = inputhdu[i].header['EXTNAME']
-            stdout_write("\rWorking on %s ... " % (extname))
+            correct_tasks.append((inputframe, template, extname, scaling))
 
-            try:
-                fringemap = templatehdu[extname].data * scaling
-                inputhdu[i].data -= fringemap
-            except:
-                print("Problem with extension",extname)
-                pass
+        pool = multiprocessing.Pool(processes=sitesetup.number_cpus)
+        for extname, corrected in pool.imap_unordered(parallel_correct_ota,
+                                                      correct_tasks):
+            stdout_write("\rWorking on %s ... " % (extname))
+            if (corrected is None):
                 continue
+            inputhdu[extname].data = corrected
+        pool.close()
+        pool.join()
 
         stdout_write(" writing ...")
 
@@ -697,8 +869,10 @@ if __name__ == "__main__":
             # Load data for each extension/OTA
             extname = datahdu[ext].header['EXTNAME']
             print("\n\n\n",extname,"\n")
-            data = datahdu[extname].data
-            fringe = fringehdu[extname].data
+            # work in float32 throughout - halves the bandwidth of the
+            # binning and all downstream statistics
+            data = datahdu[extname].data.astype(numpy.float32, copy=False)
+            fringe = fringehdu[extname].data.astype(numpy.float32, copy=False)
 
             # rebin data to cut down on processing time
             binning = 16
@@ -749,23 +923,30 @@ if __name__ == "__main__":
 
             
             def clip3sigma(data):
-                med, sigma = 0, 1e9
-                valid = numpy.isfinite(data)
+                # callers pass pre-filtered data (see valid_both above),
+                # so no finiteness pass is needed here
+                arr = data
                 for rep in range(3):
-                    med = numpy.median(data[valid])
-                    sigma = 0.5 * (scipy.stats.scoreatpercentile(data[valid], 84) - 
-                                   scipy.stats.scoreatpercentile(data[valid], 16))
-                    valid = (data < med + 3*sigma) & (data > med - 3*sigma)
-                return numpy.median(data[valid])
-
-            fringe_top10 = clip3sigma(fringe_binned[select_top10])
-            fringe_bottom10 = clip3sigma(fringe_binned[select_bottom10])
+                    # one partition pass instead of a median plus two
+                    # separate scoreatpercentile sorts
+                    p16, med, p84 = numpy.percentile(arr, [16, 50, 84])
+                    sigma = 0.5 * (p84 - p16)
+                    arr = arr[(arr < med + 3*sigma) & (arr > med - 3*sigma)]
+                return bottleneck.nanmedian(arr)
+
+            # extract the four pixel samples once - clip3sigma and the
+            # histogram dumps below all work on the same slices
+            fringe_top = fringe_binned[select_top10]
+            fringe_bottom = fringe_binned[select_bottom10]
+            sky_top = data_binned[select_top10]
+            sky_bottom = data_binned[select_bottom10]
+
+            fringe_top10 = clip3sigma(fringe_top)
+            fringe_bottom10 = clip3sigma(fringe_bottom)
 
             # Now get intensities in the original frame for the same pixels
-            #sky_top10 = numpy.median(data_binned[select_top10])
-            #sky_bottom10 = numpy.median(data_binned[select_bottom10])
-            sky_top10 = clip3sigma(data_binned[select_top10])
-            sky_bottom10 = clip3sigma(data_binned[select_bottom10])
+            sky_top10 = clip3sigma(sky_top)
+            sky_bottom10 = clip3sigma(sky_bottom)
 
             #sys.exit(0)
 
@@ -775,14 +956,11 @@ if __name__ == "__main__":
             fringe_scaling = (sky_top10-sky_bottom10)/(fringe_top10-fringe_bottom10)
             print("scaling = ", fringe_scaling)
 
-            def save_histogram(target, data, nbins=100):
-                valid = numpy.isfinite(data)
-                med = numpy.median(data[valid])
-                ls, us = scipy.stats.scoreatpercentile(data[valid], 16), scipy.stats.scoreatpercentile(data[valid], 84)
-                sigma = 0.5 * (us - ls)
+            def save_histogram(target, data, med, sigma, nbins=100):
+                # callers pass pre-filtered data and precomputed stats
                 min = med - 3*sigma
                 max = med + 3*sigma
-                histogram, binedges = numpy.histogram(data[valid], bins=nbins, range=(min,max))
+                histogram, binedges = numpy.histogram(data, bins=nbins, range=(min,max))
                 nice_histogram = numpy.empty(shape=(histogram.shape[0], 3))
                 nice_histogram[:,0] = binedges[:-1]
                 nice_histogram[:,1] = binedges[1:]
@@ -790,13 +968,13 @@ if __name__ == "__main__":
                 numpy.savetxt(target, nice_histogram)
 
             dump = open("xxx.dump"+extname, "w")
-            save_histogram(dump, fringe_binned[select_top10])
-            print("\n\n\n\n\n", file=dump)
-            save_histogram(dump, fringe_binned[select_bottom10])
-            print("\n\n\n\n\n", file=dump)
-            save_histogram(dump, data_binned[select_top10])
-            print("\n\n\n\n\n", file=dump)
-            save_histogram(dump, data_binned[select_bottom10])
+            for i, sample in enumerate(
+                    [fringe_top, fringe_bottom, sky_top, sky_bottom]):
+                if (i > 0):
+                    print("\n\n\n\n\n", file=dump)
+                # all three quantiles from one partition pass per sample
+                ls, med, us = numpy.percentile(sample, [16, 50, 84])
+                save_histogram(dump, sample, med, 0.5*(us - ls))
             dump.close()
 
 #            output_hdulist.append(pyfits.ImageHDU(data=data))
@@ -824,8 +1002,9 @@ if __name__ == "__main__":
             # Load data for each extension/OTA
             extname = datahdu[ext].header['EXTNAME']
             print("\n\n\n",extname,"\n")
-            data = datahdu[extname].data
-            fringe = fringehdu[extname].data
+            # work in float32 throughout, as in the -optimize branch
+            data = datahdu[extname].data.astype(numpy.float32, copy=False)
+            fringe = fringehdu[extname].data.astype(numpy.float32, copy=False)
 
             # rebin data to cut down on processing time
             binning = 8
@@ -844,12 +1023,23 @@ if __name__ == "__main__":
                 return bottleneck.nanmean( numpy.fabs((skysub - scale*fringe)*fringe) )
                 #return bottleneck.nanmean( ((skysub - scale*fringe)*fringe)**2 )
 
-            initial_guess = 100
-            res = scipy.optimize.fmin(min_stat, initial_guess, 
-                                      args=(skysub, fringe_binned),
-                                      full_output=True)
-            print(res)
-            res_fits = [[res[0][0], res[1], res[2], res[3], res[4]]]
+            # The objective is a weighted L1 regression through the
+            # origin: |skysub - scale*fringe| * |fringe| equals
+            # fringe**2 * |skysub/fringe - scale|, so its exact
+            # minimizer is the weighted median of skysub/fringe with
+            # weights fringe**2 - one sort instead of the dozens of
+            # full-array passes scipy.optimize.fmin needed
+            good = numpy.isfinite(skysub) & numpy.isfinite(fringe_binned) \
+                   & (fringe_binned != 0)
+            ratio = skysub[good] / fringe_binned[good]
+            weights = fringe_binned[good]**2
+            si = numpy.argsort(ratio)
+            cumulative = numpy.cumsum(weights[si])
+            scale = ratio[si[numpy.searchsorted(cumulative, 0.5*cumulative[-1])]]
+
+            quality = min_stat(scale, skysub, fringe_binned)
+            print(scale, quality)
+            res_fits = [[scale, quality, 0, 1, 0]]
             all_results = numpy.array(res_fits) if all_results is None else numpy.append(all_results, res_fits, axis=0)
 
 #            xopt, fopt, iter, funcalls, warnflag, allvecs = res
@@ -934,9 +1124,9 @@ if __name__ == "__main__":
         print("median scaling=",median_scaling)
 
         for rep in range(3):
-            lsig = scipy.stats.scoreatpercentile(scaling_factors[valid], 16)
-            hsig = scipy.stats.scoreatpercentile(scaling_factors[valid], 84)
-            median = numpy.median(scaling_factors[valid])
+            # all three quantiles from one partition pass
+            lsig, median, hsig = \
+                numpy.percentile(scaling_factors[valid], [16, 50, 84])
             sigma = 0.5 * (hsig - lsig)
             #print median, sigma
             valid = (scaling_factors > median-3*sigma) & (scaling_factors < median+3*sigma)
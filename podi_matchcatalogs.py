@@ -30,11 +30,43 @@ podi_matchcatalogs contains all functionality for matching source catalogs.
 import sys
 import numpy
 import os
+import scipy.spatial
 from podi_definitions import *
 import logging
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 arcsec = 1./3600.
 
+if (numba is not None):
+    @numba.njit(cache=True, parallel=True, fastmath=True)
+    def _match_nn(ref_xy, odi_xy, max_d2):
+        """
+
+        Nearest-neighbour search for the segment matcher: for every
+        reference position return the index of the closest ODI source
+        within the matching radius, or -1. Plain loops let numba run
+        the reference stars in parallel and vectorize the
+        squared-distance computation.
+
+        """
+        closest = numpy.full((ref_xy.shape[0],), -1, dtype=numpy.int64)
+        for i in numba.prange(ref_xy.shape[0]):
+            best_d = max_d2
+            best_j = -1
+            for j in range(odi_xy.shape[0]):
+                dx = ref_xy[i,0] - odi_xy[j,0]
+                dy = ref_xy[i,1] - odi_xy[j,1]
+                d = dx*dx + dy*dy
+                if (d < best_d):
+                    best_d = d
+                    best_j = j
+            closest[i] = best_j
+        return closest
+
 def match_catalogs(ref_full, odi_full, matching_radius=2, verbose=False):
 
     # numpy.savetxt("ref_raw", ref_full)
@@ -60,7 +92,10 @@ def match_catalogs(ref_full, odi_full, matching_radius=2, verbose=False):
     dummy, ra_ranges = numpy.histogram([], bins=5, range=(ref_ra_min, ref_ra_max))
     dummy, dec_ranges = numpy.histogram([], bins=5, range=(ref_dec_min, ref_dec_max))
 
-    matched_cat = None
+    # Collect the columnar segment results and assemble the final
+    # monolithic catalog once at the end - each column group stays
+    # contiguous until then
+    segments = []
     for cur_ra in range(ra_ranges.shape[0]-1):
         for cur_dec in range(dec_ranges.shape[0]-1):
 
@@ -74,8 +109,17 @@ def match_catalogs(ref_full, odi_full, matching_radius=2, verbose=False):
             if (matched_cat_segment is None):
                 continue
 
-            matched_cat = matched_cat_segment if (matched_cat is None) \
-                else numpy.append(matched_cat, matched_cat_segment, axis=0)
+            segments.append(matched_cat_segment)
+
+    if (len(segments) <= 0):
+        return None
+
+    matched_cat = numpy.hstack([
+        numpy.concatenate([seg['ref_radec'] for seg in segments], axis=0),
+        numpy.concatenate([seg['odi_radec'] for seg in segments], axis=0),
+        numpy.concatenate([seg['ref_extra'] for seg in segments], axis=0),
+        numpy.concatenate([seg['odi_extra'] for seg in segments], axis=0),
+    ])
 
     # numpy.savetxt("matched.raw", matched_cat)
     # Fix coordinates with negative RAs
@@ -111,39 +155,54 @@ def match_catalog_segment(ref_full, odi_full, ra_ranges, dec_ranges,
     logger.debug("Searching for reference stars: RA: %3.1f - %3.1f,  DEC: %+4.1f - %+4.1f" % (
             ra_ranges[0]-d_ra, ra_ranges[1]+d_ra,dec_ranges[0]-d_dec,dec_ranges[1]+d_dec))
 
-    # Create the output array, and set all ODI position to the "not found" standard value
-    output_array = numpy.zeros(shape=(ref.shape[0], ref.shape[1]+odi.shape[1]))
-    output_array[:, 2:4] = -99999.9
-
-    # Copy all values from the reference catalog
-    odi_data_start = 4 + ref.shape[1] - 2 
-    output_array[:, 0:2] = ref[:, 0:2]
-    output_array[:, 4:odi_data_start] = ref[:, 2:]
+    # Create the per-column output blocks (structure-of-arrays: each
+    # group of columns is one contiguous array), and set all ODI
+    # positions to the "not found" standard value
+    odi_radec = numpy.zeros(shape=(ref.shape[0], 2))
+    odi_radec[:,:] = -99999.9
+    odi_extra = numpy.zeros(shape=(ref.shape[0], odi_full.shape[1]-2))
+    found = numpy.zeros(shape=(ref.shape[0],), dtype=bool)
 
     matches_found = 0
     if (odi.shape[0] > 0):
         #
-        # Now for each star, find the closest match in the reference catalog
+        # Now for each star, find the closest match in the ODI catalog.
+        # One kd-tree query covers all reference stars at once, instead
+        # of a python loop with a full distance computation and sort per
+        # star. All distances are measured with Ra scaled by the cosine
+        # of the median declination - the segments are narrow enough
+        # that a single scale is accurate to well below the matching
+        # radius.
         #
         matching_radius = 2 * arcsec
-        matching_radius_squared = matching_radius * matching_radius
-        for star in range(ref.shape[0]):
-
-            d_ra  = (ref[star,0] - odi[:,0]) * math.cos(math.radians(ref[star,1]))
-            d_dec = (ref[star,1] - odi[:,1])
-            sq_d = d_ra * d_ra + d_dec * d_dec
-
-            si = numpy.argsort(sq_d)
-            if (sq_d[si[0]] < matching_radius_squared):
-                # The closest match is a valid one, with distance < matching_radius
-                # Copy the ODI coordinates and catalog data into the output format
-                output_array[star, 2:4] = odi[si[0], 0:2]
-                output_array[star, odi_data_start:] = odi[si[0], 2:]
-                matches_found += 1
+        cos_dec = math.cos(math.radians(numpy.median(ref[:,1])))
+        ref_xy = numpy.column_stack([ref[:,0] * cos_dec, ref[:,1]])
+        odi_xy = numpy.column_stack([odi[:,0] * cos_dec, odi[:,1]])
+        if (numba is not None):
+            # compiled brute-force search, parallel across reference
+            # stars; un-matched stars come back as index -1
+            closest = _match_nn(ref_xy, odi_xy,
+                                matching_radius * matching_radius)
+            found = closest >= 0
+        else:
+            odi_tree = scipy.spatial.cKDTree(odi_xy)
+            d, closest = odi_tree.query(ref_xy, k=1,
+                                        distance_upper_bound=matching_radius)
+            # un-matched stars come back with infinite distance
+            found = numpy.isfinite(d)
+        # Copy the ODI coordinates and catalog data into the output format
+        odi_radec[found, :] = odi[closest[found], 0:2]
+        odi_extra[found, :] = odi[closest[found], 2:]
+        matches_found = numpy.sum(found)
 
     logger.debug("  -->    %5d matches (%5d vs %5d)" % (matches_found, ref.shape[0], odi.shape[0]))
     
-    return output_array
+    return {'ref_radec': ref[:, 0:2],
+            'odi_radec': odi_radec,
+            'ref_extra': ref[:, 2:],
+            'odi_extra': odi_extra,
+            'matched': found,
+        }
 
     
 if __name__ == "__main__":
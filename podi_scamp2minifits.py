@@ -168,8 +168,16 @@ def scamp_header_to_minifits(filename, minifits_outputname, reference_fits,
         print(numpy.std(centers, axis=0))
         print(numpy.std(centers, axis=0)*3600.)
     else:
-        wcs = astWCS.WCS(refhdu[reference_extension].header, mode='pyfits')
-        optical_center = numpy.array(wcs.getCentreWCSCoords())
+        # the field center follows directly from the header keywords via
+        # CRVAL + CD.(NAXIS/2 - CRPIX); no need to construct a full
+        # astWCS solution (with all its header parsing) just for this
+        hdr = refhdu[reference_extension].header
+        center_xy = numpy.array([0.5*hdr['NAXIS1'] - hdr['CRPIX1'],
+                                 0.5*hdr['NAXIS2'] - hdr['CRPIX2']])
+        cd = numpy.array([[hdr['CD1_1'], hdr['CD1_2']],
+                          [hdr['CD2_1'], hdr['CD2_2']]])
+        optical_center = numpy.array([hdr['CRVAL1'], hdr['CRVAL2']]) \
+                         + cd.dot(center_xy)
 
     #
     # Now modify and re-fit the WCS with the correct reference point
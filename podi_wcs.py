@@ -87,30 +87,38 @@ def wcs_wcspoly_to_header(wcs_polynomials, hdr):
 
     xi, xi_r, eta, eta_r, cd, crval, crpix = wcs_polynomials
 
+    # Collect all keyword/value pairs first and write them back with a
+    # single batched update at the end - every individual assignment via
+    # hdr[...] = value triggers its own search through the card list
+
+    cards = []
+
     # write CRPIX and CRVALs
     for i in range(2):
-        hdr['CRPIX%d' % (i+1)] = crpix[i]
-        hdr['CRVAL%d' % (i+1)] = crval[i]
+        cards.append(('CRPIX%d' % (i+1), crpix[i]))
+        cards.append(('CRVAL%d' % (i+1), crval[i]))
 
     # write CDx_y
     for (i,j) in itertools.product(range(2),range(2)):
-        hdr['CD%d_%d' % (i+1,j+1)] = cd[i,j]
+        cards.append(('CD%d_%d' % (i+1,j+1), cd[i,j]))
 
     # Write all non-radial distortion terms
     for (i,j) in itertools.product(range(ordering.shape[0]), range(ordering.shape[1])):
         x = ordering[i,j]
         if (x <= 0):
             continue
-        hdr['PV1_%d' % (x)] = xi[i,j]
-        hdr['PV2_%d' % (x)] = eta[i,j]
+        cards.append(('PV1_%d' % (x), xi[i,j]))
+        cards.append(('PV2_%d' % (x), eta[i,j]))
 
     # And finally, finish the radial terms
     for i in range(ordering_r.shape[1]):
         x = ordering_r[0,i]
         if (x <= 0):
             continue
-        hdr['PV1_%d' % (x)] = xi_r[0,i]
-        hdr['PV2_%d' % (x)] = eta_r[0,i]
+        cards.append(('PV1_%d' % (x), xi_r[0,i]))
+        cards.append(('PV2_%d' % (x), eta_r[0,i]))
+
+    hdr.update(cards)
 
     return
 
@@ -10,6 +10,7 @@ import scipy
 import scipy.stats
 import math
 import scipy.spatial
+import scipy.ndimage
 import itertools
 
 from  podi_definitions import *
@@ -111,33 +112,43 @@ if __name__ == "__main__":
     # i.e. the most frequently occuring
     #
 
-    candidate_offset_tree = scipy.spatial.cKDTree(all_offsets)
-    
-    # n_coincidences = candidate_tree.count_neighbors(candidate_tree, (5./3600.), p=2)
-    # coincidences = candidate_tree.query_ball_tree(candidate_tree, (5./3600.), p=2)
-
-    # search_weights = numpy.zeros(shape=(len(coincidences),3))
-
-    # for i in range(len(coincidences)):
-    #     search_weights[i,0] = len(coincidences[i])
-    #     search_weights[i,1:3] = all_offsets[i,:]
-
-    search_weights = numpy.zeros(shape=(all_offsets.shape[0],3))
-    search_weights[:,1:3] = all_offsets
-    for i in range(all_offsets.shape[0]):
-        neighbors = candidate_offset_tree.query_ball_point(search_weights[i,1:3], (5./3600.), p=2)
-        search_weights[i,0] = len(neighbors)
-        #search_weights[i,0] = candidate_offset_tree.count_neighbors(
-        #    scipy.spatial.cKDTree(search_weights[i,1:3]), (5./3600.), p=2)
-
-    # Find which offset has the highest weight
-    max_coincidence_count = numpy.argmax(search_weights[:,0])
-
-    best_offset = all_offsets[max_coincidence_count,:]
+    # Finding the most frequent offset is the same as finding the densest
+    # 2-d bin of roughly the coincidence radius in size, so bin all offsets
+    # onto a fixed grid in a single pass - no need to build a kD-tree of
+    # all candidate offsets and query it N times
+    coincidence_radius = 5./3600.
+    off_min = numpy.min(all_offsets, axis=0)
+    off_max = numpy.max(all_offsets, axis=0)
+    n_bins = (numpy.ceil((off_max - off_min) / coincidence_radius).astype(int) + 1)
+    H, xedges, yedges = numpy.histogram2d(
+        all_offsets[:,0], all_offsets[:,1], bins=n_bins,
+        range=[[off_min[0], off_min[0] + n_bins[0]*coincidence_radius],
+               [off_min[1], off_min[1] + n_bins[1]*coincidence_radius]])
+
+    # sum each 3x3 neighborhood so peaks straddling a bin border are not
+    # split across cells; this approximates a circle of the search radius
+    H_window = scipy.ndimage.uniform_filter(H, size=3, mode='constant') * 9.
+
+    ix, iy = numpy.unravel_index(numpy.argmax(H_window), H_window.shape)
+    cell_center = numpy.array([0.5*(xedges[ix] + xedges[ix+1]),
+                               0.5*(yedges[iy] + yedges[iy+1])])
+
+    # for the final precision, pick from all offsets near the peak cell the
+    # one with the most neighbors within the coincidence radius
+    near_peak = numpy.hypot(all_offsets[:,0] - cell_center[0],
+                            all_offsets[:,1] - cell_center[1]) < (2*coincidence_radius)
+    candidates = all_offsets[near_peak]
+    counts = numpy.sum(numpy.hypot(candidates[:,0:1] - all_offsets[:,0],
+                                   candidates[:,1:2] - all_offsets[:,1])
+                       < coincidence_radius, axis=1)
+    max_coincidence_count = int(numpy.argmax(counts))
+
+    best_offset = candidates[max_coincidence_count,:].copy()
     print("best offset", best_offset)
-    print("matching in", search_weights[max_coincidence_count], "fields")
+    print("matching in", counts[max_coincidence_count], "fields")
 
-    numpy.savetxt("ccmatch.offsetcount", search_weights)
+    # For debugging, dump the windowed coincidence grid
+    numpy.savetxt("ccmatch.offsetcount", H_window)
 
 
 